@@ -161,7 +161,18 @@ def work(ifield=0):
                     )
             mi = sim_data["band_data"][band_name][0].getMaskedImage()
             gdata = mi.getImage().getArray()
-            pyfits.writeto(gal_fname, gdata)
+            if itest == 3:
+                # the mask plane is saved in the "MASK" extension, and the bit
+                # of each mask plane (e.g., BAD for bad columns, SAT for star
+                # bleeds and CR for cosmic rays) in the MP_* header keywords
+                mask = mi.getMask()
+                mhdu = pyfits.ImageHDU(mask.getArray(), name="MASK")
+                for plane, bit in mask.getMaskPlaneDict().items():
+                    mhdu.header["MP_%s" % plane] = bit
+                pyfits.HDUList([pyfits.PrimaryHDU(gdata), mhdu]).writeto(gal_fname)
+                del mask, mhdu
+            else:
+                pyfits.writeto(gal_fname, gdata)
             del mi, gdata
     return
 
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# FPFS shear estimator
+# Copyright 20261017 Xiangchong Li.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+import time
+import fpfs
+import numpy as np
+from argparse import ArgumentParser
+
+
+def make_test_image(ngal, rcut, noise, seed, shear=(0.0, 0.0)):
+    """Makes an image of isolated exponential galaxies placed on a row of
+    stamps, and returns the image, the PSF and the galaxy coordinates
+    """
+    rng = np.random.RandomState(seed)
+    ngrid = 2 * rcut
+    sim = fpfs.simutil.sim_test(shear=shear, rng=rng, scale=0.2, ngrid=ngrid)
+    gals = [sim.make_image(noise=noise, do_shift=True)[0] for _ in range(ngal)]
+    img = np.hstack(gals)
+    coords = np.vstack(
+        [np.ones(ngal, dtype=int) * rcut, np.arange(ngal, dtype=int) * ngrid + rcut]
+    ).T
+    return img, sim.psf, coords
+
+
+def time_measure(task, img, coords, ntest=5):
+    # measure returns numpy arrays, so the calls are synchronous
+    out = task.measure(img, coords, chunk_size=256)
+    t0 = time.time()
+    for _ in range(ntest):
+        task.measure(img, coords, chunk_size=256)
+    return np.asarray(out), (time.time() - t0) / ntest / len(coords)
+
+
+def run_kernel(args):
+    """Accuracy of the real-space kernels as a function of truncation"""
+    img, psf, coords = make_test_image(args.ngal, args.rcut, args.noise, args.seed)
+    task = fpfs.image.measure_source(
+        psf, pix_scale=0.2, sigma_arcsec=args.sigma_as, sigma_detect=args.sigma_det
+    )
+    ref, tref = time_measure(task, img, coords)
+    names = [tp[0] for tp in task.mode_types]
+    scale = np.std(ref, axis=0)
+    print("Fourier: %.3e seconds per source" % tref)
+    print("%8s %12s %12s %10s" % ("rcut", "max err", "worst mode", "sec/src"))
+    for rr in range(args.rcut, 3, -args.step):
+        ktask = fpfs.image.measure_source(
+            psf,
+            pix_scale=0.2,
+            sigma_arcsec=args.sigma_as,
+            sigma_detect=args.sigma_det,
+            kernel_rcut=rr,
+        )
+        out, tt = time_measure(ktask, img, coords)
+        # error relative to the scatter of each mode over the sample
+        err = np.max(np.abs(out - ref), axis=0) / scale
+        print("%8d %12.3e %12s %10.3e" % (rr, np.max(err), names[np.argmax(err)], tt))
+    return
+
+
+def run_precision(args):
+    """Change of multiplicative bias and throughput in float32 mode"""
+    shear = 0.02
+    imgs = {}
+    for sign in [1, -1]:
+        img, psf, coords = make_test_image(
+            args.ngal, args.rcut, args.noise, args.seed, shear=(sign * shear, 0.0)
+        )
+        imgs[sign] = img
+    print(
+        "%10s %12s %12s %12s %12s" % ("precision", "m", "dm", "max err", "sec/src")
+    )
+    ref = None
+    for precision in ["float64", "float32"]:
+        task = fpfs.image.measure_source(
+            psf,
+            pix_scale=0.2,
+            sigma_arcsec=args.sigma_as,
+            sigma_detect=args.sigma_det,
+            precision=precision,
+        )
+        e1 = []
+        r1 = []
+        for sign in [1, -1]:
+            out, tt = time_measure(task, imgs[sign], coords)
+            ells = fpfs.catalog.fpfs_m2e(task.get_results(out), const=args.const)
+            e1.append(np.sum(ells["fpfs_e1"]))
+            r1.append(np.sum(ells["fpfs_R1E"]))
+        mbias = (e1[0] - e1[1]) / (r1[0] + r1[1]) / shear - 1.0
+        if ref is None:
+            ref = out
+            mref = mbias
+        err = np.max(np.abs(out - ref) / np.std(ref, axis=0))
+        print(
+            "%10s %12.3e %12.3e %12.3e %12.3e"
+            % (precision, mbias, mbias - mref, err, tt)
+        )
+    return
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="fpfs benchmarks")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+    parser_kernel = subparsers.add_parser(
+        "kernel",
+        help="accuracy of real-space kernels versus truncation",
+    )
+    parser_kernel.set_defaults(func=run_kernel)
+    parser_precision = subparsers.add_parser(
+        "precision",
+        help="multiplicative bias and throughput in float32 mode",
+    )
+    parser_precision.set_defaults(func=run_precision)
+    parser_precision.add_argument(
+        "--const", default=2000.0, type=float, help="weighting parameter of e"
+    )
+    for pp in [parser_kernel, parser_precision]:
+        pp.add_argument("--ngal", default=1000, type=int, help="number of galaxies")
+        pp.add_argument("--rcut", default=32, type=int, help="stamp half size")
+        pp.add_argument("--noise", default=1e-3, type=float, help="noise std")
+        pp.add_argument("--seed", default=1, type=int, help="random seed")
+        pp.add_argument("--sigma_as", default=0.52, type=float, help="sigma_as")
+        pp.add_argument("--sigma_det", default=0.53, type=float, help="sigma_det")
+    parser_kernel.add_argument(
+        "--step", default=4, type=int, help="step of the truncation radius"
+    )
+    args = parser.parse_args()
+    args.func(args)
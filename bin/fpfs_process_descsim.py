@@ -31,6 +31,20 @@ band_map = {
     "a": 4,
 }
 
+# bits of the mask planes in the LSST convention, which are used if the
+# "MASK" extension does not record them in the MP_* header keywords
+mask_plane_bits = {
+    "BAD": 0,
+    "SAT": 1,
+    "INTRP": 2,
+    "CR": 3,
+    "EDGE": 4,
+    "DETECTED": 5,
+    "DETECTED_NEGATIVE": 6,
+    "SUSPECT": 7,
+    "NO_DATA": 8,
+}
+
 version = 1
 
 if version == 1:
@@ -108,10 +122,23 @@ class Worker(object):
 
         # setup FPFS task
         self.psf_fname = cparser.get("files", "psf_fname")
+        fpfs.cache.enable_caches(cparser, "files")
         self.sigma_as = cparser.getfloat("FPFS", "sigma_as")
         self.sigma_det = cparser.getfloat("FPFS", "sigma_det")
         self.rcut = cparser.getint("FPFS", "rcut")
         self.nnord = cparser.getint("FPFS", "nnord", fallback=4)
+        # detect in tiles of this size on large exposures [0: whole exposure]
+        self.detect_tile_size = cparser.getint("FPFS", "detect_tile_size", fallback=0)
+        # only keep the brightest peak within min_sep pixels [0: keep all]
+        self.min_sep = cparser.getfloat("FPFS", "min_sep", fallback=0.0)
+        # the mask planes of bad pixels (e.g., DETECTED is not bad)
+        self.bad_mask_planes = [
+            plane.strip()
+            for plane in cparser.get(
+                "FPFS", "bad_mask_planes", fallback="BAD,SAT,CR,NO_DATA"
+            ).split(",")
+            if len(plane.strip()) > 0
+        ]
         if self.nnord not in [4, 6]:
             raise ValueError(
                 "Only support for nnord= 4 or nnord=6, but your input\
@@ -125,7 +152,13 @@ class Worker(object):
         self.magz = cparser.getfloat("survey", "mag_zero")
         self.band = cparser.get("survey", "band")
         self.scale = cparser.getfloat("survey", "pixel_scale")
-        self.nstd_f = nstd_map[self.band] * self.noise_ratio
+        # several bands (e.g., "griz") are detected jointly on their weighted
+        # combination in memory, instead of on the coadd ("a") on disk
+        self.blist = list(self.band) if len(self.band) > 1 else []
+        if len(self.blist) > 0:
+            self.nstd_f = nstd_map["a"] * self.noise_ratio
+        else:
+            self.nstd_f = nstd_map[self.band] * self.noise_ratio
         ngrid = 2 * self.rcut
         self.noise_pow = np.ones((ngrid, ngrid)) * self.nstd_f**2.0 * ngrid**2.0
         return
@@ -133,9 +166,7 @@ class Worker(object):
     def prepare_noise_psf(self, fname):
         exposure = pyfits.getdata(fname)
         self.image_nx = exposure.shape[1]
-        psf_array2 = pyfits.getdata(self.psf_fname)
-        npad = (self.image_nx - psf_array2.shape[0]) // 2
-        psf_array3 = np.pad(psf_array2, (npad, npad), mode="constant")
+        psf_array2 = np.asarray(pyfits.getdata(self.psf_fname), dtype="<f8")
         if not os.path.isfile(self.ncov_fname):
             # FPFS noise cov task
             noise_task = fpfs.image.measure_noise_cov(
@@ -149,29 +180,52 @@ class Worker(object):
             pyfits.writeto(self.ncov_fname, cov_elem, overwrite=True)
         else:
             cov_elem = pyfits.getdata(self.ncov_fname)
-        return psf_array2, psf_array3, cov_elem
+        return psf_array2, cov_elem
 
-    def prepare_image(self, fname):
+    def prepare_image(self, fname, band=None):
+        if band is None:
+            band = self.band
+            nstd_f = self.nstd_f
+        else:
+            nstd_f = nstd_map[band] * self.noise_ratio
         gal_array = np.zeros((self.image_nx, self.image_nx))
-        print("processing %s band" % self.band)
+        print("processing %s band" % band)
         gal_array = pyfits.getdata(fname)
-        if self.nstd_f > 1e-10:
+        if nstd_f > 1e-10:
             # noise
-            seed = get_seed_from_fname(fname, self.band)
+            seed = get_seed_from_fname(fname, band)
             rng = np.random.RandomState(seed)
-            print("Using noisy setup with std: %.2f" % self.nstd_f)
+            print("Using noisy setup with std: %.2f" % nstd_f)
             print("The random seed is %d" % seed)
             gal_array = gal_array + rng.normal(
-                scale=self.nstd_f,
+                scale=nstd_f,
                 size=gal_array.shape,
             )
         else:
             print("Using noiseless setup")
         return gal_array
 
-    def process_image(self, gal_array, psf_array2, psf_array3, cov_elem):
-        # measurement task
-        meas_task = fpfs.image.measure_source(
+    def prepare_mask(self, fname):
+        # the mask of bad pixels, selected from the mask plane by the bitmask
+        # of bad_mask_planes, if the image has one
+        with pyfits.open(fname) as hdul:
+            if "MASK" not in hdul:
+                return None
+            header = hdul["MASK"].header
+            bitmask = 0
+            for plane in self.bad_mask_planes:
+                key = "MP_%s" % plane
+                if key in header:
+                    bitmask |= 1 << int(header[key])
+                elif plane in mask_plane_bits:
+                    bitmask |= 1 << mask_plane_bits[plane]
+                else:
+                    raise ValueError("Cannot find the bit of mask plane: %s" % plane)
+            return (hdul["MASK"].data.astype(np.int64) & bitmask) != 0
+
+    def get_meas_task(self, psf_array2):
+        # measurement task (cached, so it only compiles once per worker)
+        meas_task = fpfs.cache.get_measure_source(
             psf_array2,
             sigma_arcsec=self.sigma_as,
             sigma_detect=self.sigma_det,
@@ -181,7 +235,9 @@ class Worker(object):
         print(
             "The upper limit of Fourier wave number is %s pixels" % (meas_task.klim_pix)
         )
+        return meas_task
 
+    def get_thresholds(self, cov_elem):
         std_modes = np.sqrt(np.diagonal(cov_elem))
         idm00 = fpfs.catalog.indexes["m00"]
         idv0 = fpfs.catalog.indexes["v0"]
@@ -195,27 +251,116 @@ class Worker(object):
             cutmag = self.magz * 0.935
             thres = 10 ** ((self.magz - cutmag) / 2.5) * self.scale**2.0
             thres2 = -0.05
+        return thres, thres2
 
-        coords = fpfs.image.detect_sources(
-            gal_array,
-            psf_array3,
-            sigmaf=meas_task.sigmaf,
-            sigmaf_det=meas_task.sigmaf_det,
+    def process_image(self, gal_array, psf_array2, cov_elem, mask=None):
+        meas_task = self.get_meas_task(psf_array2)
+        thres, thres2 = self.get_thresholds(cov_elem)
+        if self.detect_tile_size > 0:
+            coords = meas_task.detect_sources_tiled(
+                gal_array,
+                psf_array2,
+                thres=thres,
+                thres2=thres2,
+                bound=self.rcut + 5,
+                tile_size=self.detect_tile_size,
+                min_sep=self.min_sep or None,
+                mask=mask,
+            )
+        else:
+            # the PSF is padded to the image (and cached) for detection
+            coords = meas_task.detect_sources(
+                gal_array,
+                psf_array2,
+                thres=thres,
+                thres2=thres2,
+                bound=self.rcut + 5,
+                min_sep=self.min_sep or None,
+                mask=mask,
+            )
+        print("pre-selected number of sources: %d" % len(coords))
+        if mask is None:
+            out = meas_task.get_results(meas_task.measure(gal_array, coords))
+        else:
+            # the masked fraction is saved in the last column
+            out, mask_frac = meas_task.measure_masked(gal_array, mask, coords)
+            out = meas_task.get_results(out, mask_frac)
+        sel = (out["fpfs_M00"] + out["fpfs_M20"]) > 0.0
+        out = out[sel]
+        print("final number of sources: %d" % len(out))
+        coords = coords[sel]
+        coords = np.rec.fromarrays(coords.T, dtype=[("fpfs_y", "i4"), ("fpfs_x", "i4")])
+        return out, coords
+
+    def process_bands(self, gal_cube, psf_array2, cov_elem):
+        meas_task = self.get_meas_task(psf_array2)
+        thres, thres2 = self.get_thresholds(cov_elem)
+        coords, out_bands, out = meas_task.measure_bands(
+            gal_cube,
+            psf_array2,
+            weights=[w_map[band] for band in self.blist],
             thres=thres,
             thres2=thres2,
             bound=self.rcut + 5,
+            chunk_size=256,
         )
         print("pre-selected number of sources: %d" % len(coords))
-        out = meas_task.measure(gal_array, coords)
         out = meas_task.get_results(out)
         sel = (out["fpfs_M00"] + out["fpfs_M20"]) > 0.0
         out = out[sel]
+        out_bands = [meas_task.get_results(oo)[sel] for oo in out_bands]
         print("final number of sources: %d" % len(out))
         coords = coords[sel]
         coords = np.rec.fromarrays(coords.T, dtype=[("fpfs_y", "i4"), ("fpfs_x", "i4")])
-        return out, coords
+        return out, out_bands, coords
+
+    def run_bands(self, fname):
+        # fname is the image of the first band; the weighted combination is
+        # saved as band "a"
+        b0 = self.blist[0]
+        out_fname = os.path.join(self.catdir, fname.split("/")[-1])
+        out_fname = out_fname.replace("image-", "src-")
+        det_fname = out_fname.replace("src-", "det-")
+        det_fname = det_fname.replace("_%s.fits" % b0, "_a.fits")
+        src_fnames = [
+            out_fname.replace("_%s.fits" % b0, "_%s.fits" % band)
+            for band in self.blist + ["a"]
+        ]
+        if all(os.path.isfile(ff) for ff in src_fnames + [det_fname]):
+            print("Already has measurement for this simulation. ")
+            return
+        # the catalogs of an interrupted run are removed, since save_catalog
+        # appends to existing files
+        for ff in src_fnames + [det_fname]:
+            if os.path.isfile(ff):
+                os.remove(ff)
+        psf_array2, cov_elem = self.prepare_noise_psf(fname)
+        fnames = [
+            fname.replace("_%s.fits" % b0, "_%s.fits" % band) for band in self.blist
+        ]
+        # the joint measurement of the bands does not support mask planes
+        for ff in fnames:
+            if self.prepare_mask(ff) is not None:
+                raise ValueError(
+                    "Mask planes are not supported in the joint measurement "
+                    "of bands: %s" % ff
+                )
+        gal_cube = np.stack(
+            [self.prepare_image(ff, band=band) for ff, band in zip(fnames, self.blist)]
+        )
+        start_time = time.time()
+        cat, cat_bands, det = self.process_bands(gal_cube, psf_array2, cov_elem)
+        elapsed_time = time.time() - start_time
+        print(f"Elapsed time: {elapsed_time} seconds")
+        for ff, cc in zip(src_fnames, cat_bands + [cat]):
+            fpfs.io.save_catalog(ff, cc, dtype="shape", nnord=str(self.nnord))
+        # the detection catalog is saved last, so an interrupted run is rerun
+        fpfs.io.save_catalog(det_fname, det, dtype="position", nnord=str(self.nnord))
+        return
 
     def run(self, fname):
+        if len(self.blist) > 0:
+            return self.run_bands(fname)
         out_fname = os.path.join(self.catdir, fname.split("/")[-1])
         out_fname = out_fname.replace("image-", "src-")
 
@@ -224,10 +369,11 @@ class Worker(object):
         if os.path.isfile(out_fname) and os.path.isfile(det_fname):
             print("Already has measurement for this simulation. ")
             return
-        psf_array2, psf_array3, cov_elem = self.prepare_noise_psf(fname)
+        psf_array2, cov_elem = self.prepare_noise_psf(fname)
         gal_array = self.prepare_image(fname)
+        mask = self.prepare_mask(fname)
         start_time = time.time()
-        cat, det = self.process_image(gal_array, psf_array2, psf_array3, cov_elem)
+        cat, det = self.process_image(gal_array, psf_array2, cov_elem, mask=mask)
         # Stop the timer
         end_time = time.time()
         # Calculate the elapsed time
@@ -284,7 +430,7 @@ if __name__ == "__main__":
         args.max_id,
         2,
         2,
-        worker.band,
+        worker.band if len(worker.blist) == 0 else worker.blist[0],
     )
     for r in pool.map(worker.run, fname_list):
         pass
@@ -35,11 +35,21 @@ class Worker(object):
         self.sigma_as = cparser.getfloat("FPFS", "sigma_as")
         self.sigma_det = cparser.getfloat("FPFS", "sigma_det")
         self.rcut = cparser.getint("FPFS", "rcut")
+        # number of sources measured in one vectorized call
+        self.chunk_size = cparser.getint("FPFS", "chunk_size", fallback=256)
+        # clear the compiled programs after each image, which saves memory but
+        # recompiles (or reloads from the compilation cache) every image
+        self.clear_jax_caches = cparser.getboolean(
+            "FPFS", "clear_jax_caches", fallback=False
+        )
         if not os.path.exists(self.imgdir):
             raise FileNotFoundError("Cannot find input images directory!")
         if not os.path.exists(self.catdir):
             os.makedirs(self.catdir, exist_ok=True)
         print("The output directory for shear catalogs is %s. " % self.catdir)
+        # persistent caches of compiled programs, PSF products and bases, which
+        # are shared by the workers
+        fpfs.cache.enable_caches(cparser, "files")
 
         # order of shear estimator
         self.nnord = cparser.getint("FPFS", "nnord", fallback=4)
@@ -137,8 +147,8 @@ class Worker(object):
             cov_elem = pyfits.getdata(self.ncov_fname)
         std_modes = np.sqrt(np.diagonal(cov_elem))
 
-        # FPFS measurement task
-        meas_task = fpfs.image.measure_source(
+        # FPFS measurement task (cached, so it only compiles once per worker)
+        meas_task = fpfs.cache.get_measure_source(
             psf_data2,
             sigma_arcsec=self.sigma_as,
             nnord=self.nnord,
@@ -177,16 +187,14 @@ class Worker(object):
                 print("Already has measurement for this simulation.")
                 continue
 
-            coords = fpfs.image.detect_sources(
+            coords = meas_task.detect_sources(
                 gal_data,
                 psf_data3,
-                sigmaf=meas_task.sigmaf,
-                sigmaf_det=meas_task.sigmaf_det,
                 thres=thres,
                 thres2=thres2,
             )
             print("pre-selected number of sources: %d" % len(coords))
-            out = meas_task.measure(gal_data, coords)
+            out = meas_task.measure(gal_data, coords, chunk_size=self.chunk_size)
             out = meas_task.get_results(out)
             sel = (out["fpfs_M00"] + out["fpfs_M20"]) > 0.0
             out = out[sel]
@@ -201,8 +209,8 @@ class Worker(object):
             )
             del out, coords, gal_data, out_fname
             gc.collect()
-            jax.clear_caches()
-        jax.clear_caches()
+            if self.clear_jax_caches:
+                jax.clear_caches()
         print("finish %s" % (imid))
         return
 
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# FPFS shear estimator
+# Copyright 20261017 Xiangchong Li.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+import fpfs
+from argparse import ArgumentParser
+from configparser import ConfigParser, ExtendedInterpolation
+from fpfs.tasks import ProcessSimulationTask
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="compiles the fpfs functions ahead of time and writes them "
+        "to the persistent compilation cache"
+    )
+    parser.add_argument(
+        "--config",
+        required=True,
+        type=str,
+        help="configure file name",
+    )
+    parser.add_argument(
+        "--image_nx",
+        default=None,
+        type=int,
+        help="image size [default: image_nx of the simulation]",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        type=str,
+        help="compilation cache directory [default: jax_cache_dir in the "
+        "configuration, or $FPFS_CACHE_DIR/jax]",
+    )
+    args = parser.parse_args()
+    cparser = ConfigParser(interpolation=ExtendedInterpolation())
+    cparser.read(args.config)
+    # the task enables the cache in jax_cache_dir if it is in the configuration
+    worker = ProcessSimulationTask(args.config)
+    if args.cache_dir is not None or not cparser.has_option("files", "jax_cache_dir"):
+        fpfs.cache.enable_compilation_cache(args.cache_dir)
+    worker.warmup(args.image_nx)
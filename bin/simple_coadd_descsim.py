@@ -18,7 +18,6 @@ import schwimmbad
 import numpy as np
 import astropy.io.fits as pyfits
 
-# from fpfs.io import save_image
 from argparse import ArgumentParser
 from configparser import ConfigParser
 
@@ -86,36 +85,81 @@ elif version == 2:
 
 
 class Worker(object):
-    def __init__(self, config_name):
+    def __init__(self, config_name, block_rows=256, use_float32=False):
         cparser = ConfigParser()
         cparser.read(config_name)
         self.img_dir = cparser.get("procsim", "img_dir")
         if not os.path.isdir(self.img_dir):
             raise FileNotFoundError("Cannot find input images directory!")
         print("The input directory for galaxy images is %s. " % self.img_dir)
+        # number of image rows read and coadded at a time
+        self.block_rows = block_rows
+        if use_float32:
+            self.dtype = np.float32
+        else:
+            self.dtype = np.float64
         return
 
+    def open_band(self, fname):
+        """Opens a band image without reading the data; rows are read from the
+        memory map (or only the necessary tiles of a compressed image)"""
+        hdul = pyfits.open(fname, memmap=True)
+        for hdu in hdul:
+            if hdu.is_image and hdu.header.get("NAXIS", 0) == 2:
+                return hdul, hdu
+        hdul.close()
+        raise ValueError("Cannot find the image in %s" % fname)
+
     def prepare(self, fname):
-        header = pyfits.getheader(fname)
-        self.image_nx = int(header["NAXIS1"])
+        hdul, hdu = self.open_band(fname)
+        self.image_nx = int(hdu.header["NAXIS1"])
+        self.image_ny = int(hdu.header["NAXIS2"])
+        hdul.close()
         return
 
-    def prepare_image(self, fname):
+    def prepare_image(self, fname, out_fname):
+        """Coadds the bands block by block, and streams the blocks to the
+        output file, so that only a few blocks of rows are in memory"""
         blist = ["g", "r", "i", "z"]
         self.prepare(fname)
-        # dtp = np.float32
-        dtp = np.float64
-        gal_array = np.zeros((self.image_nx, self.image_nx), dtype=dtp)
-        weight_all = 0.0
-        for band in blist:
-            print("%s-band running" % band)
-            weight = w_map[band]
-            weight_all = weight_all + weight
-            fname2 = fname.replace("_g.fits", "_%s.fits" % band)
-            this_gal = pyfits.getdata(fname2)
-            gal_array = gal_array + this_gal * weight
-        gal_array = gal_array / weight_all
-        return gal_array
+        print("coadding bands %s in blocks of %d rows" % (blist, self.block_rows))
+        weight_all = np.sum([w_map[band] for band in blist])
+        bands = [
+            self.open_band(fname.replace("_g.fits", "_%s.fits" % band))
+            for band in blist
+        ]
+        header = pyfits.PrimaryHDU(np.zeros((1, 1), dtype=self.dtype)).header
+        header["NAXIS1"] = self.image_nx
+        header["NAXIS2"] = self.image_ny
+        # write to a temporary file, so an interrupted coadd is not mistaken
+        # for a finished one; StreamingHDU appends to an existing file, so a
+        # stale temporary file (of the same process id) is removed first
+        tmp_fname = "%s.%d.tmp" % (out_fname, os.getpid())
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        try:
+            shdu = pyfits.StreamingHDU(tmp_fname, header)
+            block = np.empty((self.block_rows, self.image_nx), dtype=self.dtype)
+            try:
+                for r0 in range(0, self.image_ny, self.block_rows):
+                    r1 = min(r0 + self.block_rows, self.image_ny)
+                    acc = block[: r1 - r0]
+                    acc[:] = 0.0
+                    for band, (_, hdu) in zip(blist, bands):
+                        # accumulate in place, without full-image temporaries
+                        acc += hdu.section[r0:r1, :] * (w_map[band] / weight_all)
+                    shdu.write(acc)
+            finally:
+                shdu.close()
+            os.replace(tmp_fname, out_fname)
+        except BaseException:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            raise
+        finally:
+            for hdul, _ in bands:
+                hdul.close()
+        return
 
     def run(self, fname):
         print("running on image: %s" % fname)
@@ -125,9 +169,7 @@ class Worker(object):
         if os.path.exists(out_fname):
             print("Already has image. ")
             return
-        exposure = self.prepare_image(fname)
-        # save_image(out_fname, exposure)
-        pyfits.writeto(out_fname, exposure)
+        self.prepare_image(fname, out_fname)
         return
 
 
@@ -151,6 +193,18 @@ if __name__ == "__main__":
         type=int,
         help="maximum ID, e.g. 4000",
     )
+    parser.add_argument(
+        "--block_rows",
+        default=256,
+        type=int,
+        help="number of image rows coadded at a time",
+    )
+    parser.add_argument(
+        "--float32",
+        default=False,
+        action="store_true",
+        help="accumulate and write the coadd in float32",
+    )
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         "--ncores",
@@ -168,7 +222,7 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
     pool = schwimmbad.choose_pool(mpi=args.mpi, processes=args.n_cores)
-    worker = Worker(args.config)
+    worker = Worker(args.config, block_rows=args.block_rows, use_float32=args.float32)
 
     band = "g"
     fname_list = get_sim_fname(
@@ -9,6 +9,7 @@ from . import pltutil
 from . import default
 from . import pltutil
 from . import tasks
+from . import cache
 from .default import __data_dir__
 
 # We need accuracy is below 1e-6
@@ -25,4 +26,5 @@ __all__ = [
     "default",
     "io",
     "tasks",
+    "cache",
 ]
@@ -0,0 +1,269 @@
+# FPFS shear estimator
+# Copyright 20261017 Xiangchong Li.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# python lib
+import os
+import jax
+import logging
+import numpy as np
+from collections import OrderedDict
+
+from . import image
+from . import imgutil
+from .imgutil import array_hash
+from .default import __cache_dir__
+
+
+logging.basicConfig(
+    format="%(asctime)s %(message)s",
+    datefmt="%Y/%m/%d %H:%M:%S --- ",
+    level=logging.INFO,
+)
+
+# measurement tasks (with their compiled functions) keyed by configuration
+_task_cache = OrderedDict()
+task_cache_size = 8
+
+
+def _freeze(value):
+    # hashable version of a keyword argument; arrays are keyed by content
+    if isinstance(value, np.ndarray):
+        return ("ndarray", array_hash(value))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(vv) for vv in value)
+    return value
+
+
+def get_measure_source(
+    psf_data,
+    pix_scale,
+    sigma_arcsec,
+    sigma_detect=None,
+    nnord=4,
+    **kwargs,
+):
+    """Returns a measure_source task for the configuration. Tasks are cached
+    by (PSF hash, which covers the stamp size, pix_scale, sigma_arcsec,
+    sigma_detect, nnord and other keyword arguments of measure_source), so
+    that the jitted functions of a task are compiled once and reused for all
+    of the exposures with the same configuration.
+
+    Args:
+        psf_data (ndarray):     an average PSF image used to initialize the task
+        pix_scale (float):      pixel scale in arcsec
+        sigma_arcsec (float):   Shapelet kernel size
+        sigma_detect (float):   detection kernel size
+        nnord (int):            the highest order of Shapelets radial components
+                                [default: 4]
+        **kwargs:               other keyword arguments of measure_source
+    Returns:
+        task (measure_source):  the measurement task
+    """
+    psf_data = np.asarray(psf_data, dtype=np.float64)
+    if sigma_detect is None:
+        sigma_detect = sigma_arcsec
+    key = (
+        array_hash(psf_data),
+        float(pix_scale),
+        float(sigma_arcsec),
+        float(sigma_detect),
+        int(nnord),
+        tuple(sorted((kk, _freeze(vv)) for kk, vv in kwargs.items())),
+    )
+    if key in _task_cache:
+        _task_cache.move_to_end(key)
+        return _task_cache[key]
+    logging.info("Building a new measure_source task")
+    task = image.measure_source(
+        psf_data,
+        pix_scale=pix_scale,
+        sigma_arcsec=sigma_arcsec,
+        sigma_detect=sigma_detect,
+        nnord=nnord,
+        **kwargs,
+    )
+    _task_cache[key] = task
+    while len(_task_cache) > task_cache_size:
+        _task_cache.popitem(last=False)
+    return task
+
+
+def clear_task_cache():
+    """Clears the cached measurement tasks"""
+    _task_cache.clear()
+    return
+
+
+def enable_compilation_cache(cache_dir=None):
+    """Enables the persistent (on-disk) cache of compiled XLA programs, so
+    that the jitted functions are compiled once and loaded by the following
+    processes (e.g., workers of a pool) with the same configuration.
+
+    Args:
+        cache_dir (str):    directory of the compilation cache [default: None,
+                            "jax" under $FPFS_CACHE_DIR or ~/.cache/fpfs]
+    Returns:
+        cache_dir (str):    directory of the compilation cache
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(__cache_dir__, "jax")
+    os.makedirs(cache_dir, exist_ok=True)
+    jax.config.update("jax_compilation_cache_dir", cache_dir)
+    # cache every program, since the measurement is dominated by many small
+    # programs which are fast to compile but compiled by every worker
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0.0)
+    jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+    logging.info("Using compilation cache in %s" % cache_dir)
+    return cache_dir
+
+
+def enable_psf_cache(cache_dir=None):
+    """Enables the on-disk store of PSF products (Fourier transforms, powers
+    and padded PSFs, see imgutil.get_psf_product), which are saved as npy
+    files and loaded as read-only memory maps, so the processes sharing the
+    store share the pages of the files (the jitted functions taking them as
+    inputs may still copy them)
+
+    Args:
+        cache_dir (str):    directory of the store [default: None, "psf" under
+                            $FPFS_CACHE_DIR or ~/.cache/fpfs]
+    Returns:
+        cache_dir (str):    directory of the store
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(__cache_dir__, "psf")
+    os.makedirs(cache_dir, exist_ok=True)
+    imgutil.psf_product_dir = cache_dir
+    logging.info("Using PSF product cache in %s" % cache_dir)
+    return cache_dir
+
+
+def enable_basis_cache(cache_dir=None):
+    """Enables the on-disk store of the (truncated) shapelet and detectlet
+    bases (see imgutil.get_basis), which are saved as npy files, so that
+    they are only computed once by the processes sharing the store
+
+    Args:
+        cache_dir (str):    directory of the store [default: None, "basis"
+                            under $FPFS_CACHE_DIR or ~/.cache/fpfs]
+    Returns:
+        cache_dir (str):    directory of the store
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(__cache_dir__, "basis")
+    os.makedirs(cache_dir, exist_ok=True)
+    imgutil.basis_dir = cache_dir
+    logging.info("Using basis cache in %s" % cache_dir)
+    return cache_dir
+
+
+def enable_caches(cparser, section="files"):
+    """Enables the on-disk caches whose directories are set in a section of
+    a configuration: jax_cache_dir (compiled programs, see
+    enable_compilation_cache), psf_cache_dir (PSF products, see
+    enable_psf_cache) and basis_cache_dir (bases, see enable_basis_cache);
+    the caches which are not set (or empty) are not enabled
+
+    Args:
+        cparser (ConfigParser): configuration
+        section (str):          section of the directories [default: "files"]
+    """
+    for option, func in [
+        ("jax_cache_dir", enable_compilation_cache),
+        ("psf_cache_dir", enable_psf_cache),
+        ("basis_cache_dir", enable_basis_cache),
+    ]:
+        cache_dir = cparser.get(section, option, fallback="")
+        if len(cache_dir) > 0:
+            func(cache_dir)
+    return
+
+
+def compile_measure_source(
+    task,
+    image_shape,
+    chunk_size=256,
+    psf_data=None,
+    tile_size=None,
+    min_sep=None,
+    mask=False,
+    preselect=False,
+    max_peaks=16384,
+):
+    """Compiles the detection and measurement functions of a task for
+    exposures in shape of image_shape, by running them on a noise image with
+    the options of the pipeline. So every program of the pipeline, including
+    the small operations around the jitted functions, is compiled and written
+    to the compilation cache if enabled (see enable_compilation_cache). The
+    measurement is compiled for all of the chunk sizes used by measure.
+
+    Args:
+        task (measure_source):  the measurement task
+        image_shape (tuple):    shape of the exposures
+        chunk_size (int):       maximum number of sources per chunk of the
+                                measurement [default: 256]
+        psf_data (ndarray):     PSF image for detection [default: None, only
+                                compile the measurement]
+        tile_size (int):        tile size of the detection [default: None,
+                                detect on the whole exposure]
+        min_sep (float):        min_sep of the detection [default: None]
+        mask (bool):            whether the exposures have mask planes, which
+                                are used in detection and measure_masked
+                                [default: False]
+        preselect (bool):       whether the sources are detected with
+                                detect_modes [default: False]
+        max_peaks (int):        max_peaks of detect_modes [default: 16384]
+    """
+    image_shape = tuple(int(nn) for nn in image_shape)
+    img = np.random.RandomState(0).normal(size=image_shape)
+    msk = np.zeros(image_shape, dtype=bool) if mask else None
+    if psf_data is not None:
+        # the thresholds are arguments of the compiled programs, and the
+        # number of detections does not change the programs
+        thres = float(np.std(img))
+        if preselect:
+            task.detect_modes(
+                img,
+                psf_data,
+                thres,
+                0.0,
+                max_peaks=max_peaks,
+                chunk_size=chunk_size,
+                min_sep=min_sep,
+                tile_size=tile_size,
+            )
+        elif tile_size:
+            task.detect_sources_tiled(
+                img,
+                psf_data,
+                thres,
+                0.0,
+                tile_size=tile_size,
+                min_sep=min_sep,
+                mask=msk,
+            )
+        else:
+            task.detect_sources(img, psf_data, thres, 0.0, min_sep=min_sep, mask=msk)
+    # measurement; images with fewer sources than chunk_size are measured in
+    # chunks whose sizes are powers of two
+    chunk_size = int(chunk_size)
+    sizes = [1 << ii for ii in range(chunk_size.bit_length()) if 1 << ii < chunk_size]
+    center = np.array(image_shape) // 2
+    for nn in sizes + [chunk_size]:
+        coords = np.tile(center, (nn, 1))
+        if mask:
+            task.measure_masked(img, msk, coords, chunk_size=chunk_size)
+        else:
+            task.measure(img, coords, chunk_size=chunk_size)
+    logging.info("Compiled measurement functions for shape %s" % (image_shape,))
+    return
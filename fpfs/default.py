@@ -23,3 +23,7 @@ cutP = 0.005
 cutRU = 2.0
 
 __data_dir__ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+# persistent cache of fpfs (e.g., compiled XLA programs)
+__cache_dir__ = os.environ.get(
+    "FPFS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "fpfs")
+)
@@ -17,8 +17,11 @@ import jax
 import logging
 import numpy as np
 import jax.numpy as jnp
+import numpy.lib.recfunctions as rfn
 from . import imgutil
 from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 logging.basicConfig(
@@ -28,6 +31,23 @@ logging.basicConfig(
 )
 
 
+def _deconv_pow(arr, order):
+    """Raises the PSF array to the deconvolution order. Integer orders are
+    evaluated with repeated multiplication so that the result does not depend
+    on how XLA vectorizes the (complex) pow function
+    """
+    if float(order).is_integer():
+        return arr ** int(order)
+    return arr**order
+
+
+def _project(mat, data):
+    """Projects a batch of vectors [nvec, npix] onto the rows of a matrix
+    [nrow, npix] with one matrix product
+    """
+    return jnp.dot(data, mat.T)
+
+
 def results_coords(dd):
     coords = np.rec.fromarrays(
         dd.T,
@@ -46,6 +66,11 @@ class measure_base:
         sigma_detect (float):   detection kernel size
         nnord (int):            the highest order of Shapelets radial
                                 components [default: 4]
+        precision (str):        precision of FFTs and projections, "float64"
+                                or "float32" [default: "float64"]
+        klim_azimuth (bool):    whether determine klim by the PSF in all
+                                directions instead of on the two principal
+                                axes [default: False]
     """
 
     _DefaultName = "measure_base"
@@ -57,18 +82,31 @@ class measure_base:
         sigma_arcsec,
         sigma_detect=None,
         nnord=4,
+        precision="float64",
+        klim_azimuth=False,
     ):
         if sigma_arcsec <= 0.0 or sigma_arcsec > 5.0:
             raise ValueError("sigma_arcsec should be positive and less than 5 arcsec")
+        if precision == "float64":
+            self.dtype = jnp.float64
+            self.cdtype = jnp.complex128
+        elif precision == "float32":
+            self.dtype = jnp.float32
+            self.cdtype = jnp.complex64
+        else:
+            raise ValueError(
+                "precision should be 'float64' or 'float32', but got %s" % precision
+            )
+        self.precision = precision
         self.ngrid = psf_data.shape[0]
         self.nnord = nnord
         if sigma_detect is None:
             sigma_detect = sigma_arcsec
 
         # Preparing PSF
-        psf_data = jnp.array(psf_data, dtype="<f8")
-        self.psf_fourier = jnp.fft.fftshift(jnp.fft.fft2(psf_data))
-        self.psf_pow = imgutil.get_fourier_pow_fft(psf_data)
+        psf_data = np.asarray(psf_data, dtype="<f8")
+        self.psf_fourier = imgutil.get_psf_product(psf_data, "fft")
+        self.psf_pow = imgutil.get_psf_product(psf_data, "pow")
 
         # A few import scales
         self.pix_scale = pix_scale
@@ -91,8 +129,9 @@ class measure_base:
         # effective nyquest wave number
         self.klim_pix = imgutil.get_klim(
             psf_array=self.psf_pow,
-            sigma=(sigma_pixf + sigma_pixf_det) / 2.0 / jnp.sqrt(2.0),
+            sigma=(sigma_pixf + sigma_pixf_det) / 2.0 / np.sqrt(2.0),
             thres=1e-20,
+            azimuth=klim_azimuth,
         )  # in pixel units
         self.klim_pix = min(self.klim_pix, self.ngrid // 2 - 1)
 
@@ -105,9 +144,23 @@ class measure_base:
         )
         self._indy = self._indx[:, None]
         self._ind2d = jnp.ix_(self._indx, self._indx)
+
+        # Pixels within the disk |k| <= klim_pix, where the bases are nonzero
+        kk = self.klim_pix
+        ky, kx = np.meshgrid(
+            np.arange(-kk, kk + 1), np.arange(-kk, kk + 1), indexing="ij"
+        )
+        msk = (ky**2 + kx**2) <= kk**2
+        self._disk_ky = ky[msk]
+        self._disk_kx = kx[msk]
+        del ky, kx, msk
+
+        # PSF is prepared in double precision and stored in working precision
+        self.psf_fourier = self.psf_fourier.astype(self.cdtype)
+        self.psf_pow = self.psf_pow.astype(self.dtype)
         return
 
-    @partial(jax.jit, static_argnames=["self"])
+    @partial(jax.jit, static_argnames=["self", "prder", "frder"])
     def deconvolve(self, data, prder=1.0, frder=1.0):
         """Deconvolves input data with the PSF or PSF power
 
@@ -123,11 +176,11 @@ class measure_base:
             out (ndarray):
                 Deconvolved galaxy power [truncated at klim]
         """
-        out = jnp.zeros(data.shape, dtype="complex128")
+        out = jnp.zeros(data.shape, dtype=self.cdtype)
         out2 = out.at[self._ind2d].set(
             data[self._ind2d]
-            / self.psf_pow[self._ind2d] ** prder
-            / self.psf_fourier[self._ind2d] ** frder
+            / _deconv_pow(self.psf_pow[self._ind2d], prder)
+            / _deconv_pow(self.psf_fourier[self._ind2d], frder)
         )
         return out2
 
@@ -142,6 +195,11 @@ class measure_noise_cov(measure_base):
         sigma_detect (float):   detection kernel size
         nnord (int):            the highest order of Shapelets radial
                                 components [default: 4]
+        precision (str):        precision of FFTs and projections, "float64"
+                                or "float32" [default: "float64"]
+        klim_azimuth (bool):    whether determine klim by the PSF in all
+                                directions instead of on the two principal
+                                axes [default: False]
     """
 
     _DefaultName = "measure_noise_cov"
@@ -153,6 +211,8 @@ class measure_noise_cov(measure_base):
         sigma_arcsec,
         sigma_detect=None,
         nnord=4,
+        precision="float64",
+        klim_azimuth=False,
     ):
         super().__init__(
             psf_data=psf_data,
@@ -160,16 +220,20 @@ class measure_noise_cov(measure_base):
             nnord=nnord,
             pix_scale=pix_scale,
             sigma_detect=sigma_detect,
+            precision=precision,
+            klim_azimuth=klim_azimuth,
         )
-        bfunc, bnames = imgutil.fpfs_bases(
+        bfunc = imgutil.get_basis(
+            "bfunc",
             self.ngrid,
             nnord,
             self.sigmaf,
-            self.sigmaf_det,
             self.klim,
+            sigma_det=self.sigmaf_det,
+            klim_pix=self.klim_pix,
         )
-        self.bfunc = bfunc[:, self._indy, self._indx]
-        self.bnames = bnames
+        self.bfunc = jnp.array(bfunc, dtype=self.cdtype)
+        self.bnames = imgutil.fpfs_bases_names(nnord)
         return
 
     def measure(self, noise_pf):
@@ -180,7 +244,7 @@ class measure_noise_cov(measure_base):
         Return:
             cov_matrix (ndarray):   covariance matrix of FPFS basis modes
         """
-        noise_pf = jnp.array(noise_pf, dtype="<f8")
+        noise_pf = jnp.array(noise_pf, dtype=self.dtype)
         noise_pf_deconv = self.deconvolve(noise_pf, prder=1, frder=0)
         cov_matrix = (
             jnp.real(
@@ -205,9 +269,26 @@ class measure_source(measure_base):
         sigma_detect (float):   detection kernel size
         nnord (int):            the highest order of Shapelets radial components
                                 [default: 4]
+        use_rfft (bool):        whether measure on the half Fourier plane of a
+                                real FFT [True] or the full plane [False]
+                                [default: False]
+        modes (list):           names of the output modes, e.g. only measure
+                                detection modes without their shear responses
+                                [default: None, all of the modes]
+        kernel_rcut (int):      if set, measure with precomputed real-space
+                                kernels truncated to stamps of size
+                                2*kernel_rcut instead of per-stamp FFTs
+                                [default: None]
+        precision (str):        precision of FFTs and projections, "float64"
+                                or "float32" [default: "float64"]
+        klim_azimuth (bool):    whether determine klim by the PSF in all
+                                directions instead of on the two principal
+                                axes [default: False]
     """
 
     _DefaultName = "measure_source"
+    # maximum number of cached PSF Fourier transforms (see measure_psf_field)
+    psf_cache_size = 1024
 
     def __init__(
         self,
@@ -216,6 +297,11 @@ class measure_source(measure_base):
         sigma_arcsec,
         sigma_detect=None,
         nnord=4,
+        use_rfft=False,
+        modes=None,
+        kernel_rcut=None,
+        precision="float64",
+        klim_azimuth=False,
     ):
         super().__init__(
             psf_data=psf_data,
@@ -223,40 +309,147 @@ class measure_source(measure_base):
             nnord=nnord,
             pix_scale=pix_scale,
             sigma_detect=sigma_detect,
+            precision=precision,
+            klim_azimuth=klim_azimuth,
         )
         # Preparing shapelet basis
-        # nm = n*(nnord+1)+m
         # nnord is the maximum 'n' the code calculates
-        if nnord == 4:
-            # This setup is for shear response only
-            # Only uses M00, M20, M22 (real and img) and M40, M42
-            self._indM = np.array([0, 10, 12, 20, 22])[:, None, None]
-        elif nnord == 6:
-            # This setup is able to derive kappa response and shear response
-            # Only uses M00, M20, M22 (real and img), M40, M42(real and img), M60
-            self._indM = np.array([0, 14, 16, 28, 30, 42])[:, None, None]
-        else:
+        if nnord not in imgutil.shapelet_modes:
             raise ValueError(
                 "only support for nnord= 4 or nnord=6, but your input\
                     is nnord=%d"
                 % nnord
             )
-        chi = imgutil.shapelets2d(
+        # the (cached) bases on the pixels within klim
+        chi = imgutil.get_basis(
+            "chi", self.ngrid, nnord, self.sigmaf, self.klim, klim_pix=self.klim_pix
+        )
+        psi = imgutil.get_basis(
+            "psi",
             self.ngrid,
             nnord,
-            self.sigmaf,
-            self.klim,
-        )[self._indM, self._indy, self._indx]
-        psi = imgutil.detlets2d(
-            self.ngrid,
             self.sigmaf_det,
             self.klim,
-        )[:, :, self._indy, self._indx]
+            klim_pix=self.klim_pix,
+        )
         self.prepare_chi(chi)
         self.prepare_psi(psi)
         del chi, psi
+        self.use_rfft = use_rfft
+        if self.use_rfft:
+            self.chi = self.fold_half_plane(self.chi)
+            self.psi = self.fold_half_plane(self.psi)
+        self.prepare_disk()
+        self.prepare_bmat(modes)
+        self.kernel_rcut = None
+        if kernel_rcut is not None:
+            self.prepare_kernels(kernel_rcut)
+        return
+
+    def prepare_disk(self):
+        """Prepares the indexes of the pixels within klim on the (not shifted)
+        Fourier transform of a stamp [fft2, or rfft2 if use_rfft], and keeps
+        the bases and PSF only on these pixels
+        """
+        ky = self._disk_ky
+        kx = self._disk_kx
+        kk = self.klim_pix
+        if self.use_rfft:
+            sel = kx >= 0
+            ky = ky[sel]
+            kx = kx[sel]
+            # the folded bases start from kx=0
+            ind_box = (ky + kk, kx)
+        else:
+            ind_box = (ky + kk, kx + kk)
+        self._ind_disk = (ky % self.ngrid, kx % self.ngrid)
+        self.chi = self.chi[:, ind_box[0], ind_box[1]]
+        self.psi = self.psi[:, ind_box[0], ind_box[1]]
+        ind_shift = (ky + self.ngrid // 2, kx + self.ngrid // 2)
+        self.psf_fourier_d = self.psf_fourier[ind_shift]
+        self.psf_pow_d = self.psf_pow[ind_shift]
+        return
+
+    @partial(jax.jit, static_argnames=["self", "prder", "frder"])
+    def deconvolve_disk(self, data, prder=0.0, frder=1.0):
+        """Deconvolves the Fourier transform of a stamp on the pixels within
+        klim
+
+        Args:
+            data (ndarray):
+                Fourier transform (fft2, or rfft2 if use_rfft) of a stamp,
+                origin at [0, 0] (not shifted)
+            prder (float):
+                deconvlove order of PSF FT power
+            frder (float):
+                deconvlove order of PSF FT
+        Returns:
+            out (ndarray):
+                Deconvolved Fourier transform on the pixels within klim
+        """
+        out = (
+            data[self._ind_disk]
+            / _deconv_pow(self.psf_pow_d, prder)
+            / _deconv_pow(self.psf_fourier_d, frder)
+        )
+        return out
+
+    def prepare_kernels(self, rcut):
+        """Prepares the real-space kernels of the FPFS modes. Since every mode
+        is linear in the pixel values, the mode equals the dot product between
+        the stamp and a kernel, which is the inverse Fourier transform of
+        basis / PSF. The kernels are centered at the stamp center and truncated
+        to a stamp of size 2*rcut.
+
+        Args:
+            rcut (int):     half size of the truncated kernels
+        """
+        rcut = int(rcut)
+        if rcut < 1 or rcut > self.ngrid // 2:
+            raise ValueError(
+                "kernel_rcut should be in [1, %d], but got %d" % (self.ngrid // 2, rcut)
+            )
+        kernels = self.get_kernels()
+        beg = self.ngrid // 2 - rcut
+        end = beg + 2 * rcut
+        kernels = kernels[:, beg:end, beg:end]
+        self.kmat = kernels.reshape((len(kernels), -1))
+        self.kernel_rcut = rcut
         return
 
+    def get_kernels(self):
+        """Returns the (untruncated) real-space kernels of the FPFS modes
+
+        Returns:
+            kernels (ndarray):  kernels in shape of [nmodes, ngrid, ngrid]
+        """
+        if not hasattr(self, "_kernels"):
+            # the gradient of the (linear) Fourier measurement is the kernel
+            self._kernels = jax.jacrev(self._measure_stamp_fourier)(
+                jnp.zeros((self.ngrid, self.ngrid), dtype=self.dtype)
+            )
+        return self._kernels
+
+    def fold_half_plane(self, bases):
+        """Folds bases defined on the (shifted) full Fourier plane within klim
+        onto the half-plane of rfft2. Since the Fourier transform of a real
+        stamp is Hermitian, the basis at (ky, kx) and the conjugate of the
+        basis at (-ky, -kx) are merged, so that the real part of the projection
+        is unchanged.
+
+        Args:
+            bases (ndarray):    bases in shape of [n, 2klim_pix+1, 2klim_pix+1]
+        Returns:
+            out (ndarray):      bases in shape of [n, 2klim_pix+1, klim_pix+1]
+        """
+        bases = jnp.array(bases, dtype=jnp.complex128)
+        kk = self.klim_pix
+        # column kx=0 is paired with itself after the projection
+        out = bases[:, :, kk:]
+        flip = jnp.conjugate(bases[:, ::-1, kk::-1])
+        out = out.at[:, :, 1:].add(flip[:, :, 1:])
+        return out
+
     def detect_sources(
         self,
         img_data,
@@ -264,18 +457,65 @@ class measure_source(measure_base):
         thres,
         thres2,
         bound=None,
+        min_sep=None,
+        mask=None,
     ):
         """Returns the coordinates of detected sources
 
         Args:
             img_data (ndarray):         observed image
-            psf_data (ndarray):         PSF image [must be well-centered]
+            psf_data (ndarray):         PSF image [must be well-centered],
+                                        which is padded to the shape of the
+                                        image if it is smaller
             thres (float):              detection threshold
             thres2 (float):             peak identification difference threshold
-            bound (int):                remove sources at boundary
+            bound (int):                remove sources at boundary; it can be
+                                        set to a small value if sources are
+                                        measured with edge_mode
+            min_sep (float):            if set, only keep the brightest peak
+                                        (in the convolved image) within
+                                        min_sep pixels [default: None]
+            mask (ndarray):             mask plane, nonzero for the masked
+                                        pixels, which are excluded with
+                                        normalized convolution [default: None]
         Returns:
             coords (ndarray):           peak values and the shear responses
         """
+        self._check_thresholds(thres, thres2)
+        img_data = jnp.array(img_data, dtype="<f8")
+        if mask is not None:
+            mask = jnp.asarray(np.asarray(mask) != 0)
+        # the (cached) Fourier transform of the PSF padded to the image
+        psf_fourier = imgutil.get_psf_product(psf_data, "rfft", img_data.shape)
+        out = imgutil.get_detect_mask(
+            img_data,
+            psf_fourier,
+            self.sigmaf,
+            self.sigmaf_det,
+            self.klim,
+            float(thres),
+            float(thres2),
+            return_conv=min_sep is not None,
+            mask=mask,
+        )
+        if bound is None:
+            bound = self.ngrid // 2 + 5
+        if min_sep is None:
+            return imgutil.get_mask_coords(out, bound).T
+        sel, img_conv = out
+        dd = imgutil.get_mask_coords(sel, bound).T
+        values = np.asarray(img_conv)[dd[:, 0], dd[:, 1]]
+        return dd[self._remove_close_peaks(dd, values, min_sep)]
+
+    def _remove_close_peaks(self, coords, values, min_sep):
+        keep = imgutil.remove_close_peaks(coords, values, min_sep)
+        logging.info(
+            "removed %d peaks closer than %.1f pixels" % (np.sum(~keep), min_sep)
+        )
+        return keep
+
+    @staticmethod
+    def _check_thresholds(thres, thres2):
         if not isinstance(thres, (int, float)):
             raise ValueError("thres must be float, but now got %s" % type(thres))
         if not isinstance(thres2, (int, float)):
@@ -284,27 +524,417 @@ class measure_source(measure_base):
             raise ValueError("detection threshold should be positive")
         if not thres2 <= 0.0:
             raise ValueError("difference threshold should be non-positive")
-        psf_data = jnp.array(psf_data, dtype="<f8")
-        assert (
-            img_data.shape == psf_data.shape
-        ), "image and PSF should have the same\
-                shape. Please do padding before using this function."
-        img_conv = imgutil.convolve2gausspsf(
+        return
+
+    def get_detect_halo(self, psf_data, rtol=1e-8):
+        """Returns the halo of the tiles in tiled detection, i.e., the extent
+        (in pixels) of the real-space detection kernels (Gaussian deconvolved
+        by the PSF) above rtol times their peak values, plus one pixel for the
+        comparison with neighbors in the peak identification
+
+        Args:
+            psf_data (ndarray):     PSF image [must be well-centered]
+            rtol (float):           relative truncation of the kernels
+                                    [default: 1e-8]
+        Returns:
+            halo (int):             halo of the tiles
+        """
+        psf_data = np.asarray(psf_data, dtype="<f8")
+        ng = max(4 * self.ngrid, *psf_data.shape)
+        psf_fourier = imgutil.get_psf_product(psf_data, "rfft", (ng, ng))
+        rr = np.abs(np.fft.fftshift(np.arange(ng)) - ng // 2)
+        rr = np.maximum(rr[:, None], rr[None, :])
+        halo = 0
+        for sigmaf in set([self.sigmaf, self.sigmaf_det]):
+            gauss_kernel = imgutil._gauss_kernel_rfft(
+                ng, ng, sigmaf, self.klim, return_grid=False
+            )
+            kernel = np.abs(np.fft.irfft2(gauss_kernel / psf_fourier, (ng, ng)))
+            halo = max(halo, int(np.max(rr[kernel > rtol * np.max(kernel)])))
+        return halo + 1
+
+    def detect_sources_tiled(
+        self,
+        img_data,
+        psf_data,
+        thres,
+        thres2,
+        bound=None,
+        tile_size=1024,
+        halo=None,
+        ncores=1,
+        min_sep=None,
+        mask=None,
+    ):
+        """Returns the coordinates of detected sources; the image is convolved
+        in tiles with halos (overlap-save), so that the memory only depends on
+        the tile size. Peaks are only identified in the core of each tile, and
+        the cores partition the image; so the coordinates are the same as
+        detect_sources (up to the truncation of the kernels in the halo)
+
+        Args:
+            img_data (ndarray):         observed image, e.g., a memory-mapped
+                                        array which is read tile by tile
+            psf_data (ndarray):         PSF image [must be well-centered],
+                                        which is padded to the shape of the
+                                        tiles (with halo)
+            thres (float):              detection threshold
+            thres2 (float):             peak identification difference threshold
+            bound (int):                remove sources at boundary
+            tile_size (int):            size of the core of the tiles
+                                        [default: 1024]
+            halo (int):                 size of the halo of the tiles
+                                        [default: None, see get_detect_halo]
+            ncores (int):               number of threads processing tiles
+                                        [default: 1]
+            min_sep (float):            if set, only keep the brightest peak
+                                        (in the convolved image) within
+                                        min_sep pixels [default: None]
+            mask (ndarray):             mask plane, nonzero for the masked
+                                        pixels, which are excluded with
+                                        normalized convolution [default: None]
+        Returns:
+            coords (ndarray):           coordinates of peaks [y, x]
+        """
+        self._check_thresholds(thres, thres2)
+        ny, nx = img_data.shape
+        if bound is None:
+            bound = self.ngrid // 2 + 5
+        if halo is None:
+            halo = self.get_detect_halo(psf_data)
+        tile_size = int(tile_size)
+        ntile = tile_size + 2 * halo
+        # all tiles share one shape and thus one compiled program; the tiles
+        # at the boundary are wrapped around as the FFT of the full image
+        psf_fourier = imgutil.get_psf_product(psf_data, "rfft", (ntile, ntile))
+
+        def _detect_tile(corner):
+            y0, x0 = corner
+            rows = np.arange(y0 - halo, y0 + tile_size + halo) % ny
+            cols = np.arange(x0 - halo, x0 + tile_size + halo) % nx
+            tile = jnp.array(img_data[np.ix_(rows, cols)], dtype="<f8")
+            tile_mask = None
+            if mask is not None:
+                tile_mask = jnp.asarray(np.asarray(mask[np.ix_(rows, cols)]) != 0)
+            sel, img_conv = imgutil.get_detect_mask(
+                tile,
+                psf_fourier,
+                self.sigmaf,
+                self.sigmaf_det,
+                self.klim,
+                float(thres),
+                float(thres2),
+                return_conv=True,
+                mask=tile_mask,
+            )
+            sel = np.asarray(sel[halo : halo + tile_size, halo : halo + tile_size])
+            y, x = np.nonzero(sel)
+            values = np.asarray(img_conv)[y + halo, x + halo]
+            y = y + y0
+            x = x + x0
+            msk = (y > bound) & (y < ny - bound) & (x > bound) & (x < nx - bound)
+            return np.stack([y[msk], x[msk]], axis=-1), values[msk]
+
+        corners = [
+            (y0, x0) for y0 in range(0, ny, tile_size) for x0 in range(0, nx, tile_size)
+        ]
+        if ncores > 1:
+            with ThreadPoolExecutor(max_workers=ncores) as executor:
+                out = list(executor.map(_detect_tile, corners))
+        else:
+            out = [_detect_tile(cc) for cc in corners]
+        values = np.concatenate([oo[1] for oo in out])
+        out = np.concatenate([oo[0] for oo in out], axis=0)
+        # sort to the (row-major) order of detect_sources
+        inds = np.lexsort((out[:, 1], out[:, 0]))
+        out, values = out[inds], values[inds]
+        if min_sep is None:
+            return out
+        return out[self._remove_close_peaks(out, values, min_sep)]
+
+    def detect_measure(
+        self,
+        img_data,
+        psf_data,
+        thres,
+        thres2,
+        bound=None,
+        max_peaks=4096,
+        chunk_size=256,
+    ):
+        """Detects sources and measures their FPFS moments in one compiled
+        program (see detect_measure_fixed)
+
+        Args:
+            img_data (ndarray):         observed image
+            psf_data (ndarray):         PSF image [must be well-centered],
+                                        which is padded to the shape of the
+                                        image if it is smaller
+            thres (float):              detection threshold
+            thres2 (float):             peak identification difference threshold
+            bound (int):                remove sources at boundary
+            max_peaks (int):            maximum number of sources [default:
+                                        4096]; the extra sources are dropped
+                                        with a warning
+            chunk_size (int):           number of sources measured in one
+                                        vectorized call [default: 256]
+        Returns:
+            coords (ndarray):           coordinates of sources [y, x]
+            out (ndarray):              FPFS moments
+        """
+        self._check_thresholds(thres, thres2)
+        if bound is None:
+            bound = self.ngrid // 2 + 5
+        chunk_size = min(self.get_chunk_size(chunk_size), max_peaks)
+        max_peaks = -(-max_peaks // chunk_size) * chunk_size
+        img_data = jnp.array(img_data, dtype="<f8")
+        psf_fourier = imgutil.get_psf_product(psf_data, "rfft", img_data.shape)
+        coords, out, count, overflow = self.detect_measure_fixed(
             img_data,
-            psf_data,
-            self.sigmaf,
-            self.klim,
+            psf_fourier,
+            float(thres),
+            float(thres2),
+            int(bound),
+            max_peaks,
+            chunk_size,
         )
-        img_conv_det = imgutil.convolve2gausspsf(
+        if overflow:
+            logging.warning(
+                "More than max_peaks=%d sources are detected, the extra "
+                "sources are dropped" % max_peaks
+            )
+        count = int(count)
+        return np.asarray(coords)[:count], np.asarray(out)[:count]
+
+    @partial(jax.jit, static_argnames=["self", "max_peaks", "chunk_size"])
+    def detect_measure_fixed(
+        self, img_data, psf_fourier, thres, thres2, bound, max_peaks, chunk_size
+    ):
+        """Detects sources and measures their FPFS moments (jitted) with a
+        fixed capacity of sources; only the chunks of detected sources are
+        measured
+
+        Args:
+            img_data (ndarray):         observed image
+            psf_fourier (ndarray):      rfft2 of the PSF (centered at the
+                                        origin) in the shape of the image
+            thres (float):              detection threshold
+            thres2 (float):             peak identification difference threshold
+            bound (int):                remove sources at boundary
+            max_peaks (int):            capacity of sources, a multiple of
+                                        chunk_size
+            chunk_size (int):           number of sources measured in one
+                                        vectorized call
+        Returns:
+            coords (ndarray):           coordinates of sources [max_peaks, 2]
+            out (ndarray):              FPFS moments [max_peaks, nmodes]
+            count (int):                number of detected sources
+            overflow (bool):            whether more than max_peaks sources
+                                        are detected
+        """
+        sel = imgutil.get_detect_mask(
             img_data,
-            psf_data,
+            psf_fourier,
+            self.sigmaf,
             self.sigmaf_det,
             self.klim,
+            thres,
+            thres2,
+        )
+        coords, count, overflow = imgutil.get_mask_coords_fixed(sel, bound, max_peaks)
+        image = img_data.astype(self.dtype)
+
+        def _measure(ic, out):
+            cc = jax.lax.dynamic_slice_in_dim(coords, ic * chunk_size, chunk_size)
+            return jax.lax.dynamic_update_slice_in_dim(
+                out, self.measure_chunk(cc, image), ic * chunk_size, axis=0
+            )
+
+        out = jnp.zeros((max_peaks, len(self.mode_types)), dtype=self.dtype)
+        out = jax.lax.fori_loop(0, -(-count // chunk_size), _measure, out)
+        return coords, out, count, overflow
+
+    def get_detect_kernels(self, psf_data, rcut=None):
+        """Returns the real-space kernels of M20 and of the v modes along the
+        diagonals (v1, v3, v5, v7) which are used by detect_modes; the kernels
+        are flipped, so they are projected onto the pixels around a peak
+
+        Args:
+            psf_data (ndarray):     PSF image [must be well-centered]
+            rcut (int):             the kernels are truncated to stamps of
+                                    size 2*rcut+1 [default: None, see
+                                    get_detect_halo]
+        Returns:
+            kernels (ndarray):      kernels in shape of [5, 2rcut+1, 2rcut+1]
+        """
+        psf_data = np.asarray(psf_data, dtype="<f8")
+        if rcut is None:
+            rcut = self.get_detect_halo(psf_data)
+        ng = max(4 * self.ngrid, *psf_data.shape, 2 * rcut + 2)
+        psf_fourier = imgutil.get_psf_product(psf_data, "rfft", (ng, ng))
+        gauss, (ky, kx) = imgutil._gauss_kernel_rfft(
+            ng, ng, self.sigmaf, self.klim, return_grid=True
         )
+        gauss_det = imgutil._gauss_kernel_rfft(
+            ng, ng, self.sigmaf_det, self.klim, return_grid=False
+        )
+        # shifted by the unit vectors along the diagonals
+        dd = 1.0 / np.sqrt(2.0)
+        kernels = [gauss * (1.0 - (kx**2.0 + ky**2.0) / self.sigmaf**2.0)] + [
+            gauss_det * jnp.exp(1j * (kx * sx + ky * sy) * dd)
+            for sy, sx in [(1, 1), (1, -1), (-1, -1), (-1, 1)]
+        ]
+        kernels = np.fft.irfft2(np.stack(kernels) / psf_fourier, (ng, ng))
+        kernels = np.fft.fftshift(kernels, axes=(-2, -1))
+        kernels = kernels[
+            :, ng // 2 - rcut : ng // 2 + rcut + 1, ng // 2 - rcut : ng // 2 + rcut + 1
+        ]
+        return kernels[:, ::-1, ::-1]
+
+    def detect_modes(
+        self,
+        img_data,
+        psf_data,
+        thres,
+        thres2,
+        bound=None,
+        max_peaks=16384,
+        chunk_size=256,
+        min_sep=None,
+        tile_size=None,
+        halo=None,
+    ):
+        """Returns the coordinates of detected sources, and their M00, M20 and
+        v modes, which are measured together with the detection in one
+        compiled program (see imgutil.get_detect_modes); it can be used to
+        pre-select sources (e.g., M00 + M20 > 0) before measuring all of the
+        modes with measure. If tile_size is set, the image is processed in
+        tiles with halos as detect_sources_tiled
+
+        Args:
+            img_data (ndarray):         observed image
+            psf_data (ndarray):         PSF image [must be well-centered],
+                                        which is padded to the shape of the
+                                        image (or the tiles) if it is smaller
+            thres (float):              detection threshold
+            thres2 (float):             peak identification difference threshold
+            bound (int):                remove sources at boundary
+            max_peaks (int):            capacity of sources (in each tile)
+                                        [default: 16384]; it is doubled and
+                                        the detection is rerun if more sources
+                                        are detected
+            chunk_size (int):           number of sources measured in one
+                                        vectorized call [default: 256]
+            min_sep (float):            if set, only keep the brightest peak
+                                        (in M00) within min_sep pixels
+                                        [default: None]
+            tile_size (int):            size of the core of the tiles
+                                        [default: None, not tiled]
+            halo (int):                 size of the halo of the tiles
+                                        [default: None, see get_detect_halo]
+        Returns:
+            coords (ndarray):           coordinates of sources [y, x]
+            out (ndarray):              modes of sources (structured array)
+        """
+        self._check_thresholds(thres, thres2)
+        ny, nx = img_data.shape
         if bound is None:
             bound = self.ngrid // 2 + 5
-        dd = imgutil.find_peaks(img_conv, img_conv_det, thres, thres2, bound).T
-        return dd
+        if halo is None:
+            halo = self.get_detect_halo(psf_data)
+        # the kernels do not reach beyond the halo of the tiles
+        kernels = jnp.asarray(self.get_detect_kernels(psf_data, rcut=halo))
+        if tile_size is None:
+            psf_fourier = imgutil.get_psf_product(psf_data, "rfft", (ny, nx))
+            coords, out, max_peaks = self._detect_modes(
+                jnp.array(img_data, dtype="<f8"),
+                psf_fourier,
+                kernels,
+                thres,
+                thres2,
+                bound,
+                max_peaks,
+                chunk_size,
+            )
+        else:
+            tile_size = int(tile_size)
+            ntile = tile_size + 2 * halo
+            psf_fourier = imgutil.get_psf_product(psf_data, "rfft", (ntile, ntile))
+            coords, out = [], []
+            for y0 in range(0, ny, tile_size):
+                for x0 in range(0, nx, tile_size):
+                    rows = np.arange(y0 - halo, y0 + tile_size + halo) % ny
+                    cols = np.arange(x0 - halo, x0 + tile_size + halo) % nx
+                    # peaks in the halo are removed by the bound
+                    cc, oo, max_peaks = self._detect_modes(
+                        jnp.array(img_data[np.ix_(rows, cols)], dtype="<f8"),
+                        psf_fourier,
+                        kernels,
+                        thres,
+                        thres2,
+                        halo - 1,
+                        max_peaks,
+                        chunk_size,
+                    )
+                    y = cc[:, 0] - halo + y0
+                    x = cc[:, 1] - halo + x0
+                    # only the peaks in the core of the tile
+                    msk = (y < y0 + tile_size) & (x < x0 + tile_size)
+                    msk = msk & (y > bound) & (y < ny - bound)
+                    msk = msk & (x > bound) & (x < nx - bound)
+                    coords.append(np.stack([y[msk], x[msk]], axis=-1))
+                    out.append(oo[msk])
+            coords = np.concatenate(coords, axis=0)
+            out = np.concatenate(out, axis=0)
+            # sort to the (row-major) order of detect_sources
+            inds = np.lexsort((coords[:, 1], coords[:, 0]))
+            coords, out = coords[inds], out[inds]
+        out = out / self.pix_scale**2.0
+        if min_sep is not None:
+            keep = self._remove_close_peaks(coords, out[:, 0], min_sep)
+            coords, out = coords[keep], out[keep]
+        names = ["fpfs_M00", "fpfs_M20"] + ["fpfs_v%d" % i for i in range(8)]
+        out = np.rec.fromarrays(out.T, dtype=[(nn, "<f8") for nn in names])
+        return coords, out
+
+    def _detect_modes(
+        self,
+        img_data,
+        psf_fourier,
+        kernels,
+        thres,
+        thres2,
+        bound,
+        max_peaks,
+        chunk_size,
+    ):
+        # detects with imgutil.get_detect_modes, and doubles max_peaks and
+        # reruns when more than max_peaks peaks are found
+        chunk_size = min(self.get_chunk_size(chunk_size), max_peaks)
+        while True:
+            max_peaks = -(-max_peaks // chunk_size) * chunk_size
+            coords, out, count, overflow = imgutil.get_detect_modes(
+                img_data,
+                psf_fourier,
+                kernels,
+                self.sigmaf,
+                self.sigmaf_det,
+                self.klim,
+                float(thres),
+                float(thres2),
+                int(bound),
+                max_peaks,
+                chunk_size,
+            )
+            if not overflow:
+                break
+            logging.info(
+                "More than max_peaks=%d sources are detected, rerun with "
+                "max_peaks=%d" % (max_peaks, 2 * max_peaks)
+            )
+            max_peaks = 2 * max_peaks
+        count = int(count)
+        return np.asarray(coords)[:count], np.asarray(out)[:count], max_peaks
 
     def prepare_chi(self, chi):
         """Prepares the basis to estimate shapelet modes
@@ -376,102 +1006,755 @@ class measure_source(measure_base):
         self.psi = out
         return
 
+    def prepare_bmat(self, modes=None):
+        """Flattens the shapelet and detection bases into one projection
+        matrix, so that all of the modes are measured with a single matrix
+        multiplication. The real and imaginary parts are stacked along the
+        pixel axis, since only the real part of the projection is used.
+
+        Args:
+            modes (list):   names of the modes to measure, e.g. ["fpfs_M00",
+                            "fpfs_v0"] [default: None, all of the modes]
+        """
+        tps = self.chi_types + self.psi_types
+        names = [tp[0] for tp in tps]
+        if modes is None:
+            modes = names
+        for mn in modes:
+            if mn not in names:
+                raise ValueError("Do not support mode: %s" % mn)
+        inds = np.array([names.index(mn) for mn in modes])
+        self.mode_types = [tps[i] for i in inds]
+        bases = jnp.vstack([self.chi, self.psi])[inds]
+        self.bmat = jnp.hstack([bases.real, -bases.imag]).astype(self.dtype)
+        return
+
     @partial(jax.jit, static_argnames=["self"])
-    def _itransform_chi(self, data):
-        """Projects image onto shapelet basis vectors
+    def _itransform(self, data):
+        """Projects the deconvolved data of a batch of stamps onto the basis
+        vectors
 
         Args:
-            data (ndarray): image to transfer
+            data (ndarray): deconvolved Fourier transforms on the pixels within
+                            klim [nsrc, ndisk]
         Returns:
-            out (ndarray):  projection in shapelet space
+            out (ndarray):  projection in shapelet and detection spaces
+                            [nsrc, nmodes]
         """
 
         # Here we divide by self.pix_scale**2. since pixel values are flux in
         # pixel (in unit of nano Jy for HSC). After dividing pix_scale**2., in
         # units of (nano Jy/ arcsec^2), dk^2 has unit (1/ arcsec^2)
         # Correspondingly, covariances are divided by self.pix_scale**4.
-        out = (
-            jnp.sum(
-                data[None, self._indy, self._indx] * self.chi,
-                axis=(1, 2),
-            ).real
-            / self.pix_scale**2.0
-        )
+        data = jnp.concatenate([data.real, data.imag], axis=-1)
+        out = _project(self.bmat, data) / self.pix_scale**2.0
         return out
 
+    def get_chunk_size(
+        self, chunk_size=None, max_memory=None, use_kernels=None, masked=False
+    ):
+        """Returns the number of sources measured in one vectorized call
+
+        Args:
+            chunk_size (int):       requested number of sources per chunk
+            max_memory (float):     upper limit of the memory [MB] used by the
+                                    temporaries of one chunk
+            use_kernels (bool):     whether the sources are measured with the
+                                    real-space kernels [default: None, if the
+                                    task has kernels]; the measurements with
+                                    other PSFs (e.g., measure_psf_field) use
+                                    the per-stamp Fourier transforms
+            masked (bool):          whether the masked fractions are measured
+                                    in the same pass [default: False]
+        Returns:
+            chunk_size (int):       number of sources per chunk
+        """
+        if chunk_size is None:
+            chunk_size = 1024
+        if chunk_size < 1:
+            raise ValueError("chunk_size should be a positive integer")
+        if max_memory is not None:
+            if use_kernels is None:
+                use_kernels = self.kernel_rcut is not None
+            isz = jnp.dtype(self.dtype).itemsize
+            if use_kernels:
+                # truncated stamp (real)
+                nbytes = self.kmat.shape[-1] * isz
+            else:
+                # stamp (real)
+                nbytes = self.ngrid**2 * isz
+                if self.use_rfft:
+                    # Fourier transform on the half plane (complex)
+                    nbytes += self.ngrid * (self.ngrid // 2 + 1) * isz * 2
+                else:
+                    # stamp cast to complex + Fourier transform (complex)
+                    nbytes += self.ngrid**2 * isz * 4
+                # deconvolved pixels (complex) and input vector of the
+                # projection (real)
+                nbytes += self.bmat.shape[-1] * isz * 2
+            if masked:
+                # stamp of the mask (bool) and its weighted pixels (real)
+                nbytes += self.ngrid**2 * (1 + isz)
+            nmax = int(max_memory * 1024**2 // nbytes)
+            if nmax < 1:
+                raise ValueError(
+                    "max_memory=%.2f MB is too small to measure one source"
+                    % max_memory
+                )
+            chunk_size = min(chunk_size, nmax)
+        return int(chunk_size)
+
+    def get_edge_flags(self, coords, shape):
+        """Flags the sources whose stamps extend beyond the exposure
+
+        Args:
+            coords (ndarray):           coordinates of sources [y, x]
+            shape (tuple):              shape of the exposure
+        Returns:
+            flags (ndarray):            True for sources at the edge
+        """
+        coords = np.atleast_2d(coords)
+        if self.kernel_rcut is None:
+            rr = self.ngrid // 2
+        else:
+            rr = self.kernel_rcut
+        ny, nx = shape[-2:]
+        flags = (
+            (coords[:, 0] < rr)
+            | (coords[:, 0] + rr > ny)
+            | (coords[:, 1] < rr)
+            | (coords[:, 1] + rr > nx)
+        )
+        return flags
+
+    def measure(
+        self,
+        exposure,
+        coords=None,
+        chunk_size=None,
+        max_memory=None,
+        edge_mode=None,
+    ):
+        """Measures the FPFS moments
+
+        Args:
+            exposure (ndarray):         galaxy image
+            coords (ndarray):           coordinates of sources [y, x]
+            chunk_size (int):           number of sources measured in one
+                                        vectorized call [default: None,
+                                        measure sources one by one]
+            max_memory (float):         upper limit of the memory [MB] used by
+                                        one vectorized call [default: None]
+            edge_mode (str):            if set, stamps are read from the
+                                        exposure padded with this mode of
+                                        jnp.pad ("constant", "reflect",
+                                        "symmetric" or "edge"), so sources
+                                        close to the boundary can be measured;
+                                        use get_edge_flags to flag them
+                                        [default: None, stamps are shifted
+                                        inside the exposure]
+        Returns:
+            out (ndarray):              FPFS moments (numpy array)
+        """
+        if coords is None:
+            coords = np.array(exposure.shape) // 2
+        coords = np.atleast_2d(np.asarray(coords).T).T
+        exposure, coords = self._prepare_exposure(exposure, coords, edge_mode)
+        if chunk_size is None and max_memory is None:
+            func = lambda xi: self.measure_coord(xi, exposure)
+            # returned on the host, the same as the chunked measurement
+            return np.asarray(jax.lax.map(func, coords))
+
+        chunk_size = self.get_chunk_size(chunk_size, max_memory)
+        return self._measure_chunked(exposure, coords, chunk_size)
+
+    def _prepare_exposure(self, exposure, coords, edge_mode=None):
+        """Casts the exposure to the working precision, and pads it if
+        edge_mode is set"""
+        exposure = jnp.array(exposure, dtype=self.dtype)
+        if edge_mode is not None:
+            if edge_mode not in ["constant", "reflect", "symmetric", "edge"]:
+                raise ValueError("Do not support edge_mode: %s" % edge_mode)
+            npad = self.ngrid // 2
+            # only pad the last two (image) axes
+            pad_width = [(0, 0)] * (exposure.ndim - 2) + [(npad, npad)] * 2
+            exposure = jnp.pad(exposure, pad_width, mode=edge_mode)
+            coords = coords + npad
+        return exposure, coords
+
+    def _measure_chunked(
+        self, exposure, coords, chunk_size, psf_fourier_d=None, mask=None
+    ):
+        """Measures the FPFS moments with chunks of coordinates; coordinates
+        in shape of [nepoch, nsrc, 2] are measured on a stack of exposures,
+        and the masked fractions are appended to the moments with a mask.
+        The coordinates are padded and the chunks are concatenated on the
+        host, so only the chunk function depends on the number of sources"""
+        coords = np.asarray(coords)
+        nsrc = coords.shape[-2]
+        if nsrc == 0:
+            nout = len(self.mode_types) + (mask is not None)
+            return np.zeros(coords.shape[:-1] + (nout,), dtype=self.dtype)
+        # the chunks of a few sources are rounded up to a power of two, to
+        # limit the number of compiled shapes
+        chunk_size = min(chunk_size, 1 << (nsrc - 1).bit_length())
+        nchunk = -(-nsrc // chunk_size)
+        # pad the coordinate list so that every chunk has the same shape, and
+        # the chunk function is compiled only once
+        npad = nchunk * chunk_size - nsrc
+        pad_width = [(0, 0)] * (coords.ndim - 2) + [(0, npad), (0, 0)]
+        coords = np.pad(coords, pad_width, mode="edge")
+        if mask is not None:
+            func = self.measure_chunk_masked
+            exposure = (exposure, mask)
+        elif coords.ndim == 2:
+            func = self.measure_chunk
+        else:
+            func = self.measure_chunk_epochs
+        out = [
+            func(
+                coords[..., i * chunk_size : (i + 1) * chunk_size, :],
+                exposure,
+                psf_fourier_d,
+            )
+            for i in range(nchunk)
+        ]
+        return np.concatenate(out, axis=-2)[..., :nsrc, :]
+
     @partial(jax.jit, static_argnames=["self"])
-    def _itransform_psi(self, data):
-        """Projects image onto shapelet basis vectors
+    def measure_chunk(self, coords, image, psf_fourier_d=None):
+        """Measures the FPFS moments from a chunk of coordinates (jitted and
+        vectorized over the sources in the chunk)
 
         Args:
-            data (ndarray): image to transfer
+            coords (ndarray):           galaxy peak coordinates [nsrc, 2]
+            image (ndarray):            exposure
+            psf_fourier_d (ndarray):    PSF Fourier transform on the pixels
+                                        within klim [default: None, the PSF
+                                        of the task]
         Returns:
-            out (ndarray):  projection in shapelet space
+            mm (ndarray):               FPFS moments [nsrc, nmodes]
         """
+        func = jax.vmap(self._get_coord_data, in_axes=(0, None, None))
+        return self._project_data(func(coords, image, psf_fourier_d), psf_fourier_d)
 
-        # Here we divide by self.pix_scale**2. since pixel values are flux in
-        # pixel (in unit of nano Jy for HSC). After dividing pix_scale**2., in
-        # units of (nano Jy/ arcsec^2), dk^2 has unit (1/ arcsec^2)
-        # Correspondingly, covariances are divided by self.pix_scale**4.
-        # chivatives/Moments
-        out = (
-            jnp.sum(
-                data[None, self._indy, self._indx] * self.psi,
-                axis=(1, 2),
-            ).real
-            / self.pix_scale**2.0
+    @partial(jax.jit, static_argnames=["self"])
+    def measure_chunk_masked(self, coords, images, psf_fourier_d=None):
+        """Measures the FPFS moments and the masked fractions from a chunk of
+        coordinates (jitted and vectorized over the sources in the chunk);
+        the masked fraction is weighted by the Gaussian of the Shapelet kernel
+
+        Args:
+            coords (ndarray):           galaxy peak coordinates [nsrc, 2]
+            images (tuple):             exposure (with masked pixels set to
+                                        zero) and its mask plane
+            psf_fourier_d (ndarray):    PSF Fourier transform on the pixels
+                                        within klim [default: None, the PSF
+                                        of the task]
+        Returns:
+            mm (ndarray):               FPFS moments and the masked fractions
+                                        [nsrc, nmodes + 1]
+        """
+        image, mask = images
+        mm = self.measure_chunk(coords, image, psf_fourier_d)
+        rr = jnp.arange(self.ngrid) - self.ngrid // 2
+        weight = jnp.exp(-((rr[:, None] ** 2 + rr[None, :] ** 2) * self.sigmaf**2) / 2)
+        weight = weight / jnp.sum(weight)
+
+        def _mask_frac(cc):
+            stamp = jax.lax.dynamic_slice(
+                mask,
+                (cc[0] - self.ngrid // 2, cc[1] - self.ngrid // 2),
+                (self.ngrid, self.ngrid),
+            )
+            return jnp.sum((stamp != 0) * weight)
+
+        frac = jax.vmap(_mask_frac)(coords).astype(mm.dtype)
+        return jnp.concatenate([mm, frac[:, None]], axis=-1)
+
+    def measure_masked(
+        self,
+        exposure,
+        mask,
+        coords,
+        chunk_size=None,
+        max_memory=None,
+        edge_mode=None,
+    ):
+        """Measures the FPFS moments on an exposure with a mask plane; the
+        masked pixels are set to zero, and the masked fraction around each
+        source is measured in the same pass, so the affected sources can be
+        flagged (see get_results)
+
+        Args:
+            exposure (ndarray):         galaxy image
+            mask (ndarray):             mask plane, nonzero for the masked
+                                        pixels
+            coords (ndarray):           coordinates of sources [y, x]
+            chunk_size (int):           number of sources measured in one
+                                        vectorized call [default: None]
+            max_memory (float):         upper limit of the memory [MB] used by
+                                        one vectorized call [default: None]
+            edge_mode (str):            if set, stamps are read from the
+                                        exposure padded with this mode of
+                                        jnp.pad, and the padded pixels are
+                                        masked [default: None]
+        Returns:
+            out (ndarray):              FPFS moments
+            mask_frac (ndarray):        masked fractions
+        """
+        coords = np.atleast_2d(np.asarray(coords).T).T
+        mask = np.asarray(mask) != 0
+        exposure = np.where(mask, 0.0, np.asarray(exposure))
+        exposure, coords2 = self._prepare_exposure(exposure, coords, edge_mode)
+        if edge_mode is not None:
+            mask = np.pad(mask, self.ngrid // 2, constant_values=True)
+        mask = jnp.asarray(mask)
+        chunk_size = self.get_chunk_size(chunk_size, max_memory, masked=True)
+        out = self._measure_chunked(exposure, coords2, chunk_size, mask=mask)
+        return out[:, :-1], out[:, -1]
+
+    @partial(jax.jit, static_argnames=["self"])
+    def measure_chunk_epochs(self, coords, images, psf_fourier_d):
+        """Measures the FPFS moments from a chunk of coordinates on a stack of
+        exposures (jitted and vectorized over the epochs)
+
+        Args:
+            coords (ndarray):           galaxy peak coordinates
+                                        [nepoch, nsrc, 2]
+            images (ndarray):           exposures [nepoch, ny, nx]
+            psf_fourier_d (ndarray):    PSF Fourier transforms on the pixels
+                                        within klim [nepoch, ndisk]
+        Returns:
+            mm (ndarray):               FPFS moments [nepoch, nsrc, nmodes]
+        """
+        return jax.vmap(self.measure_chunk)(coords, images, psf_fourier_d)
+
+    @partial(jax.jit, static_argnames=["self"])
+    def get_noise_var_epochs(self, psf_fourier_d):
+        """Returns the variances of the modes for unit (white) pixel noise,
+        which is the sum of the squared real-space kernel of each mode
+
+        Args:
+            psf_fourier_d (ndarray):    PSF Fourier transforms on the pixels
+                                        within klim [nepoch, ndisk]
+        Returns:
+            var (ndarray):              variances [nepoch, nmodes]
+        """
+        stamp = jnp.zeros((self.ngrid, self.ngrid), dtype=self.dtype)
+
+        def _var(pp):
+            kernels = jax.jacrev(self._measure_stamp_fourier)(stamp, pp)
+            return jnp.sum(kernels**2.0, axis=(1, 2))
+
+        return jax.vmap(_var)(psf_fourier_d)
+
+    def measure_epochs(
+        self,
+        exposures,
+        psfs,
+        coords,
+        noise_var=None,
+        chunk_size=None,
+        max_memory=None,
+        edge_mode=None,
+    ):
+        """Measures the FPFS moments of sources on a stack of exposures
+        (epochs), each with its own PSF, in one vectorized call per chunk of
+        sources. The moments of the epochs are combined with inverse-variance
+        weights, where the variance of each mode is derived from the PSF and
+        the pixel noise variance of the epoch.
+
+        Args:
+            exposures (ndarray):        exposures [nepoch, ny, nx]
+            psfs (ndarray):             PSF images of the epochs, centered in
+                                        the same way as the PSF of the task
+                                        [nepoch, ngrid, ngrid]
+            coords (ndarray):           coordinates of sources [nsrc, 2], or
+                                        coordinates on each epoch
+                                        [nepoch, nsrc, 2]
+            noise_var (ndarray):        pixel noise variance of each epoch
+                                        [default: None, equal variances]
+            chunk_size (int):           number of sources measured in one
+                                        vectorized call [default: None]
+            max_memory (float):         upper limit of the memory [MB] used by
+                                        one epoch of a vectorized call
+                                        [default: None]
+            edge_mode (str):            see measure [default: None]
+        Returns:
+            out (ndarray):              FPFS moments of the epochs
+                                        [nepoch, nsrc, nmodes]
+            out_comb (ndarray):         inverse-variance combined FPFS moments
+                                        [nsrc, nmodes]
+        """
+        exposures = jnp.atleast_3d(jnp.array(exposures, dtype=self.dtype).T).T
+        nepoch = exposures.shape[0]
+        psfs = np.asarray(psfs, dtype=np.float64)
+        if psfs.shape != (nepoch, self.ngrid, self.ngrid):
+            raise ValueError(
+                "psfs should be in shape of (%d, %d, %d), but got %s"
+                % (nepoch, self.ngrid, self.ngrid, psfs.shape)
+            )
+        if noise_var is None:
+            noise_var = np.ones(nepoch)
+        noise_var = np.asarray(noise_var, dtype=np.float64)
+        if noise_var.shape != (nepoch,) or not np.all(noise_var > 0.0):
+            raise ValueError("noise_var should be %d positive numbers" % nepoch)
+        coords = np.asarray(coords)
+        if coords.ndim == 2:
+            coords = np.broadcast_to(coords, (nepoch,) + coords.shape)
+        if coords.shape[0] != nepoch:
+            raise ValueError("coords do not match the number of epochs")
+        exposures, coords = self._prepare_exposure(exposures, coords, edge_mode)
+        psf_fourier_d = jnp.stack([self.get_psf_fourier_disk(pp) for pp in psfs])
+        chunk_size = self.get_chunk_size(chunk_size, max_memory, use_kernels=False)
+        out = self._measure_chunked(exposures, coords, chunk_size, psf_fourier_d)
+        # inverse-variance weights [nepoch, nmodes]
+        weight = 1.0 / (
+            noise_var[:, None] * np.asarray(self.get_noise_var_epochs(psf_fourier_d))
+        )
+        out_comb = np.sum(out * weight[:, None, :], axis=0) / np.sum(weight, axis=0)
+        return out, out_comb
+
+    def measure_bands(
+        self,
+        band_cube,
+        psf_data,
+        weights,
+        thres,
+        thres2,
+        bound=None,
+        psfs=None,
+        chunk_size=None,
+        max_memory=None,
+    ):
+        """Detects sources once on the weighted combination of the bands,
+        and measures the FPFS moments of all of the bands at the detected
+        coordinates, with the bands vectorized in each call
+
+        Args:
+            band_cube (ndarray):        images of the bands [nband, ny, nx]
+            psf_data (ndarray):         PSF of the combined image [must be
+                                        well-centered], see detect_sources
+            weights (ndarray):          weights of the bands in the
+                                        combination
+            thres (float):              detection threshold
+            thres2 (float):             peak identification difference
+                                        threshold
+            bound (int):                remove sources at boundary
+            psfs (ndarray):             PSF images of the bands
+                                        [nband, ngrid, ngrid] [default: None,
+                                        the PSF of the task]
+            chunk_size (int):           number of sources measured in one
+                                        vectorized call [default: None]
+            max_memory (float):         upper limit of the memory [MB] used by
+                                        one band of a vectorized call
+                                        [default: None]
+        Returns:
+            coords (ndarray):           coordinates of the detections
+            out_bands (ndarray):        FPFS moments of the bands
+                                        [nband, nsrc, nmodes]
+            out (ndarray):              weighted combination of the FPFS
+                                        moments of the bands [nsrc, nmodes],
+                                        which are the moments of the combined
+                                        image if the bands share one PSF
+        """
+        band_cube = jnp.array(band_cube, dtype=self.dtype)
+        if band_cube.ndim != 3:
+            raise ValueError("band_cube should be in shape of [nband, ny, nx]")
+        nband = band_cube.shape[0]
+        weights = jnp.array(weights, dtype=self.dtype)
+        if weights.shape != (nband,):
+            raise ValueError("weights should be %d numbers" % nband)
+        weights = weights / jnp.sum(weights)
+        img_data = jnp.tensordot(weights, band_cube, axes=1)
+        coords = self.detect_sources(img_data, psf_data, thres, thres2, bound)
+        if psfs is None:
+            psf_fourier_d = jnp.broadcast_to(
+                self.psf_fourier_d, (nband,) + self.psf_fourier_d.shape
+            )
+        else:
+            psfs = np.asarray(psfs, dtype=np.float64)
+            if psfs.shape != (nband, self.ngrid, self.ngrid):
+                raise ValueError(
+                    "psfs should be in shape of (%d, %d, %d), but got %s"
+                    % (nband, self.ngrid, self.ngrid, psfs.shape)
+                )
+            psf_fourier_d = jnp.stack([self.get_psf_fourier_disk(pp) for pp in psfs])
+        chunk_size = self.get_chunk_size(chunk_size, max_memory, use_kernels=False)
+        out_bands = self._measure_chunked(
+            band_cube,
+            np.broadcast_to(coords, (nband,) + coords.shape),
+            chunk_size,
+            psf_fourier_d,
         )
+        out = np.tensordot(np.asarray(weights), out_bands, axes=1)
+        return coords, out_bands, out
+
+    def get_psf_fourier_disk(self, psf_data):
+        """Returns the Fourier transform of a PSF image on the pixels within
+        klim, which deconvolves the stamps measured with this PSF. The arrays
+        are cached by the content of the PSF image.
+
+        Args:
+            psf_data (ndarray):         PSF image in shape of [ngrid, ngrid],
+                                        centered in the same way as the PSF of
+                                        the task
+        Returns:
+            psf_fourier_d (ndarray):    PSF Fourier transform on the pixels
+                                        within klim
+        """
+        psf_data = np.asarray(psf_data, dtype=np.float64)
+        if psf_data.shape != (self.ngrid, self.ngrid):
+            raise ValueError(
+                "PSF image should be in shape of (%d, %d), but got %s"
+                % (self.ngrid, self.ngrid, psf_data.shape)
+            )
+        if not hasattr(self, "_psf_cells"):
+            self._psf_cells = OrderedDict()
+        key = imgutil.array_hash(psf_data)
+        if key in self._psf_cells:
+            self._psf_cells.move_to_end(key)
+            return self._psf_cells[key]
+        # same as gathering the shifted transform, since ngrid is even
+        out = jnp.fft.fft2(psf_data)[self._ind_disk].astype(self.cdtype)
+        self._psf_cells[key] = out
+        while len(self._psf_cells) > self.psf_cache_size:
+            self._psf_cells.popitem(last=False)
         return out
 
-    def measure(self, exposure, coords=None):
-        """Measures the FPFS moments
+    def measure_psf_field(
+        self,
+        exposure,
+        coords,
+        psf_field,
+        cell_size,
+        chunk_size=None,
+        max_memory=None,
+        edge_mode=None,
+    ):
+        """Measures the FPFS moments with a spatially varying PSF. The
+        exposure is divided into square cells, in which the PSF is assumed to
+        be constant. Sources are grouped by cell, and the sources of each cell
+        are measured in batched calls, deconvolved with the (cached) Fourier
+        transform of the PSF of the cell. Note that klim is determined by the
+        PSF of the task, and real-space kernels are not used in this mode.
 
         Args:
             exposure (ndarray):         galaxy image
-            psf_fourier (ndarray):      PSF's Fourier transform
+            coords (ndarray):           coordinates of sources [y, x]
+            psf_field (ndarray):        PSF images of the cells in shape of
+                                        [ncell_y, ncell_x, ngrid, ngrid], or a
+                                        function returning the PSF image at a
+                                        position (y, x) [pixel], which is
+                                        evaluated at the cell centers
+            cell_size (int):            size of the cells [pixel]
+            chunk_size (int):           number of sources measured in one
+                                        vectorized call [default: None]
+            max_memory (float):         upper limit of the memory [MB] used by
+                                        one vectorized call [default: None]
+            edge_mode (str):            see measure [default: None]
         Returns:
             out (ndarray):              FPFS moments
         """
-        if coords is None:
-            coords = jnp.array(exposure.shape) // 2
-        coords = jnp.atleast_2d(coords.T).T
-        func = lambda xi: self.measure_coord(xi, jnp.array(exposure))
-        return jax.lax.map(func, coords)
+        cell_size = int(cell_size)
+        if cell_size < 1:
+            raise ValueError("cell_size should be a positive integer")
+        coords = np.atleast_2d(np.asarray(coords))
+        nsrc = coords.shape[0]
+        if nsrc == 0:
+            return np.zeros((0, len(self.mode_types)), dtype=self.dtype)
+        cells = coords // cell_size
+        if callable(psf_field):
+            get_psf = lambda cy, cx: psf_field(
+                (cy + 0.5) * cell_size, (cx + 0.5) * cell_size
+            )
+        else:
+            psf_field = np.asarray(psf_field)
+            if psf_field.ndim != 4:
+                raise ValueError(
+                    "psf_field should be in shape of [ncell_y, ncell_x, ngrid, ngrid]"
+                )
+            # sources beyond the grid use the PSF of the closest cell
+            cells = np.clip(cells, 0, np.array(psf_field.shape[:2]) - 1)
+            get_psf = lambda cy, cx: psf_field[cy, cx]
+        exposure, coords = self._prepare_exposure(exposure, coords, edge_mode)
+        chunk_size = self.get_chunk_size(chunk_size, max_memory, use_kernels=False)
+
+        cell_ids, inverse = np.unique(cells, axis=0, return_inverse=True)
+        inverse = np.ravel(inverse)
+        order = np.argsort(inverse, kind="stable")
+        groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+        out = []
+        for (cy, cx), inds in zip(cell_ids, groups):
+            psf_fourier_d = self.get_psf_fourier_disk(get_psf(cy, cx))
+            out.append(
+                self._measure_chunked(exposure, coords[inds], chunk_size, psf_fourier_d)
+            )
+        # back to the order of the input coordinates
+        return np.concatenate(out, axis=0)[np.argsort(order)]
+
+    def measure_dense(self, exposure, coords):
+        """Measures the FPFS moments by computing every mode as a map over the
+        whole exposure and sampling the maps at the coordinates. The cost per
+        source does not increase with the source density, which suits crowded
+        fields. Each map is the cross-correlation between the exposure and the
+        real-space kernel of the mode, computed with FFTs, so sources within
+        ngrid//2 pixels from the boundary see periodically wrapped pixels.
+
+        Args:
+            exposure (ndarray):         galaxy image
+            coords (ndarray):           coordinates of sources [y, x]
+        Returns:
+            out (ndarray):              FPFS moments
+        """
+        coords = jnp.atleast_2d(jnp.array(coords))
+        exposure = jnp.array(exposure, dtype=self.dtype)
+        ny, nx = exposure.shape
+        if ny < self.ngrid or nx < self.ngrid:
+            raise ValueError("exposure should be larger than the stamp")
+        if self.kernel_rcut is None:
+            kernels = self.get_kernels()
+        else:
+            rr = self.kernel_rcut
+            kernels = self.kmat.reshape((-1, 2 * rr, 2 * rr))
+        return self._measure_dense(exposure, coords, kernels)
 
     @partial(jax.jit, static_argnames=["self"])
-    def measure_coord(self, cc, image):
-        """Measures the FPFS moments from a coordinate (jitted)
+    def _measure_dense(self, exposure, coords, kernels):
+        """Measures the FPFS moments from the mode maps (jitted)
 
         Args:
-            cc (ndarray):       galaxy peak coordinate
-            image (ndarray):    exposure
+            exposure (ndarray):         galaxy image
+            coords (ndarray):           coordinates of sources [nsrc, 2]
+            kernels (ndarray):          real-space kernels [nmodes, 2r, 2r]
         Returns:
-            mm (ndarray):       FPFS moments
+            out (ndarray):              FPFS moments [nsrc, nmodes]
         """
+        ny, nx = exposure.shape
+        rr = kernels.shape[-1] // 2
+        img_fourier = jnp.fft.rfft2(exposure)
+
+        def _mode_map(kernel):
+            # put the kernel center to the origin
+            kernel = jnp.pad(kernel, ((0, ny - 2 * rr), (0, nx - 2 * rr)))
+            kernel = jnp.roll(kernel, shift=(-rr, -rr), axis=(0, 1))
+            # cross-correlation
+            mode_map = jnp.fft.irfft2(
+                img_fourier * jnp.conjugate(jnp.fft.rfft2(kernel)),
+                (ny, nx),
+            )
+            return mode_map[coords[:, 0], coords[:, 1]]
+
+        return jax.lax.map(_mode_map, kernels).T
+
+    def _use_kernels(self, psf_fourier_d=None):
+        """Whether the real-space kernels are used, i.e., only with the PSF of
+        the task"""
+        return self.kernel_rcut is not None and psf_fourier_d is None
+
+    def _get_coord_data(self, cc, image, psf_fourier_d=None):
+        """Returns the data of a source which is projected onto the modes, see
+        _get_stamp_data"""
+        if self._use_kernels(psf_fourier_d):
+            rr = self.kernel_rcut
+            stamp = jax.lax.dynamic_slice(
+                image,
+                (cc[0] - rr, cc[1] - rr),
+                (2 * rr, 2 * rr),
+            )
+            return jnp.ravel(stamp.astype(self.dtype))
         stamp = jax.lax.dynamic_slice(
             image,
             (cc[0] - self.ngrid // 2, cc[1] - self.ngrid // 2),
             (self.ngrid, self.ngrid),
         )
-        return self.measure_stamp(stamp)
+        return self._get_stamp_data(stamp, psf_fourier_d)
+
+    def _get_stamp_data(self, data, psf_fourier_d=None):
+        """Returns the data of a stamp which is projected onto the modes: the
+        (truncated) stamp for the real-space kernels, or its deconvolved
+        Fourier transform on the pixels within klim"""
+        data = data.astype(self.dtype)
+        if self._use_kernels(psf_fourier_d):
+            rr = self.kernel_rcut
+            beg = self.ngrid // 2 - rr
+            return jnp.ravel(data[beg : beg + 2 * rr, beg : beg + 2 * rr])
+        if self.use_rfft:
+            gal_fourier = jnp.fft.rfft2(data)
+        else:
+            gal_fourier = jnp.fft.fft2(data)
+        if psf_fourier_d is None:
+            return self.deconvolve_disk(gal_fourier, prder=0.0, frder=1)
+        return gal_fourier[self._ind_disk] / psf_fourier_d
+
+    def _project_data(self, data, psf_fourier_d=None):
+        """Projects the data of a batch of sources (see _get_stamp_data) onto
+        the modes"""
+        if self._use_kernels(psf_fourier_d):
+            return _project(self.kmat, data)
+        return self._itransform(data)
 
     @partial(jax.jit, static_argnames=["self"])
-    def measure_stamp(self, data):
-        """Measures the FPFS moments from a stamp (jitted)
+    def measure_coord(self, cc, image, psf_fourier_d=None):
+        """Measures the FPFS moments from a coordinate (jitted)
 
         Args:
-            data (ndarray):     galaxy image array
+            cc (ndarray):               galaxy peak coordinate
+            image (ndarray):            exposure
+            psf_fourier_d (ndarray):    PSF Fourier transform on the pixels
+                                        within klim [default: None, the PSF
+                                        of the task]
         Returns:
-            mm (ndarray):       FPFS moments
+            mm (ndarray):               FPFS moments
         """
-        gal_fourier = jnp.fft.fftshift(jnp.fft.fft2(data))
-        gal_deconv = self.deconvolve(gal_fourier, prder=0.0, frder=1)
-        mm = self._itransform_chi(gal_deconv)  # FPFS shapelets
-        mp = self._itransform_psi(gal_deconv)  # FPFS detection
-        # jax.debug.print("debug: {}", mm)
-        return jnp.hstack([mm, mp])
+        data = self._get_coord_data(cc, image, psf_fourier_d)
+        return self._project_data(data[None], psf_fourier_d)[0]
 
-    def get_results(self, out):
-        tps = self.chi_types + self.psi_types
-        res = np.rec.fromarrays(out.T, dtype=tps)
+    @partial(jax.jit, static_argnames=["self"])
+    def measure_stamp(self, data, psf_fourier_d=None):
+        """Measures the FPFS moments from a stamp (jitted); the real-space
+        kernels are only used with the PSF of the task
+
+        Args:
+            data (ndarray):             galaxy image array
+            psf_fourier_d (ndarray):    PSF Fourier transform on the pixels
+                                        within klim [default: None, the PSF
+                                        of the task]
+        Returns:
+            mm (ndarray):               FPFS moments
+        """
+        data = self._get_stamp_data(data, psf_fourier_d)
+        return self._project_data(data[None], psf_fourier_d)[0]
+
+    @partial(jax.jit, static_argnames=["self"])
+    def _measure_stamp_fourier(self, data, psf_fourier_d=None):
+        """Measures the FPFS moments from a stamp in Fourier space (jitted)
+
+        Args:
+            data (ndarray):             galaxy image array
+            psf_fourier_d (ndarray):    PSF Fourier transform on the pixels
+                                        within klim [default: None, the PSF
+                                        of the task]
+        Returns:
+            mm (ndarray):               FPFS moments
+        """
+        if self.use_rfft:
+            gal_fourier = jnp.fft.rfft2(data)
+        else:
+            gal_fourier = jnp.fft.fft2(data)
+        if psf_fourier_d is None:
+            gal_deconv = self.deconvolve_disk(gal_fourier, prder=0.0, frder=1)
+        else:
+            gal_deconv = gal_fourier[self._ind_disk] / psf_fourier_d
+        # FPFS shapelets and detection modes
+        return self._itransform(gal_deconv[None])[0]
+
+    def get_results(self, out, mask_frac=None):
+        res = np.rec.fromarrays(out.T, dtype=self.mode_types)
+        if mask_frac is not None:
+            res = rfn.append_fields(
+                res, "fpfs_mask_frac", np.asarray(mask_frac), "<f8", usemask=False
+            )
+            res = res.view(np.recarray)
         return res
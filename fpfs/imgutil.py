@@ -13,11 +13,14 @@
 #
 # python lib
 
+import os
 import jax
 import math
+import hashlib
 import numpy as np
 import jax.numpy as jnp
 from functools import partial
+from collections import OrderedDict
 
 
 @partial(jax.jit, static_argnames=["ny", "nx", "klim", "return_grid"])
@@ -105,7 +108,35 @@ def get_fourier_pow_rfft(input_data):
     return out
 
 
-def detlets2d(ngrid, sigma, klim):
+def _detlets2d(gauss_ker, k2grid, k1grid, sigma):
+    """Generates the detlets in Fourier space from the Gaussian kernel and
+    the (y, x) grids (see _fourier_grids) with numpy, so that new klim, sigma
+    and grid shapes (e.g., the grids truncated to klim_pix) do not compile
+    programs; the phase factors of the 8 directions are the outer products of
+    1-D phase vectors along y and x (see detlets2d)"""
+    # for shear response
+    q1_ker = (k1grid**2.0 - k2grid**2.0) / sigma**2.0 * gauss_ker
+    q2_ker = (2.0 * k1grid * k2grid) / sigma**2.0 * gauss_ker
+    # quantities for neighbouring pixels
+    d1_ker = (-1j * k1grid) * gauss_ker
+    d2_ker = (-1j * k2grid) * gauss_ker
+    # directions of the neighbouring pixels
+    ang = np.pi / 4.0 * np.arange(8)
+    x = np.cos(ang)[:, None, None]
+    y = np.sin(ang)[:, None, None]
+    foub = np.exp(1j * y * k2grid[None, :, :1]) * np.exp(1j * x * k1grid[None, :1, :])
+    psi = np.stack(
+        [
+            gauss_ker - gauss_ker * foub,
+            q1_ker - (q1_ker + x * d1_ker - y * d2_ker) * foub,
+            q2_ker - (q2_ker + y * d1_ker + x * d2_ker) * foub,
+        ],
+        axis=1,
+    )
+    return psi
+
+
+def detlets2d(ngrid, sigma, klim, dtype=np.complex64, klim_pix=None):
     """Generates shapelets function in Fourier space, chi00 are normalized to 1.
     This function only supports square stamps: ny=nx=ngrid.
 
@@ -113,32 +144,87 @@ def detlets2d(ngrid, sigma, klim):
         ngrid (int):    number of pixels in x and y direction
         sigma (float):  scale of shapelets in Fourier space
         klim (float):   upper limit of |k|
+        dtype (type):   data type of the output [default: np.complex64]
+        klim_pix (int): only generate the pixels within klim_pix from the
+                        center on both axes [default: None, all pixels]
     Returns:
         psi (ndarray):  2d detlets basis in shape of [8,3,ngrid,ngrid]
     """
-    # Gaussian Kernel
-    gauss_ker, (k2grid, k1grid) = _gauss_kernel_fft(
-        ngrid, ngrid, sigma, klim, return_grid=True
-    )
+    gauss_ker, (k2grid, k1grid) = _fourier_grids(int(ngrid), sigma, klim, klim_pix)
     # for inverse Fourier transform
     gauss_ker = gauss_ker / ngrid**2.0
-    # for shear response
-    q1_ker = (k1grid**2.0 - k2grid**2.0) / sigma**2.0 * gauss_ker
-    q2_ker = (2.0 * k1grid * k2grid) / sigma**2.0 * gauss_ker
-    # quantities for neighbouring pixels
-    d1_ker = (-1j * k1grid) * gauss_ker
-    d2_ker = (-1j * k2grid) * gauss_ker
-    # initial output psi function
-    ny, nx = gauss_ker.shape
-    psi = np.zeros((8, 3, ny, nx), dtype=np.complex64)
-    for _ in range(8):
-        x = np.cos(np.pi / 4.0 * _)
-        y = np.sin(np.pi / 4.0 * _)
-        foub = np.exp(1j * (k1grid * x + k2grid * y))
-        psi[_, 0] = gauss_ker - gauss_ker * foub
-        psi[_, 1] = q1_ker - (q1_ker + x * d1_ker - y * d2_ker) * foub
-        psi[_, 2] = q2_ker - (q2_ker + y * d1_ker + x * d2_ker) * foub
-    return psi
+    return _detlets2d(gauss_ker, k2grid, k1grid, float(sigma)).astype(dtype)
+
+
+def _fourier_grids(ngrid, sigma, klim, klim_pix=None):
+    """Returns the Gaussian kernel truncated at klim and the (y, x) grids for
+    np.fft.fft transform with k=0 shifted to (ngrid//2, ngrid//2), same as
+    _gauss_kernel_fft but computed with numpy; if klim_pix is set, the grids
+    only cover the pixels within klim_pix from k=0 on both axes"""
+    kk = np.fft.fftshift(np.fft.fftfreq(ngrid, 1 / np.pi / 2.0))
+    if klim_pix is not None:
+        kk = kk[ngrid // 2 - klim_pix : ngrid // 2 + klim_pix + 1]
+    ygrid, xgrid = np.meshgrid(kk, kk, indexing="ij")
+    r2 = xgrid**2.0 + ygrid**2.0
+    gauss = np.exp(-r2 / 2.0 / sigma**2.0) * (r2 <= klim**2)
+    return gauss, (ygrid, xgrid)
+
+
+# (n, m) of the shapelet modes used by the estimators of order 4 and 6; order
+# 4 is for shear response only, and order 6 is able to derive kappa response
+shapelet_modes = {
+    4: [(0, 0), (2, 0), (2, 2), (4, 0), (4, 2)],
+    6: [(0, 0), (2, 0), (2, 2), (4, 0), (4, 2), (6, 0)],
+}
+
+
+def shapelets2d_modes(ngrid, modes, sigma, klim, klim_pix=None):
+    """Generates complex shapelets functions of the requested (n, m) modes in
+    Fourier space, chi00 are normalized to 1
+    [only support square stamps: ny=nx=ngrid]
+
+    Args:
+        ngrid (int):    number of pixels in x and y direction
+        modes (list):   list of (n, m), with n >= |m| and n - m even
+        sigma (float):  scale of shapelets in Fourier space
+        klim (float):   upper limit of |k|
+        klim_pix (int): only generate the pixels within klim_pix from the
+                        center on both axes [default: None, all pixels]
+    Returns:
+        chi (ndarray):  2d shapelet basis [len(modes), ngrid, ngrid]
+    """
+    gaufunc, (yfunc, xfunc) = _fourier_grids(ngrid, sigma, klim, klim_pix)
+    r2_over_sigma2 = (xfunc**2.0 + yfunc**2.0) / sigma**2.0
+    rfunc = np.sqrt(xfunc**2.0 + yfunc**2.0)
+    # e^{jphi}, which is set to zero at the origin
+    eulfunc = np.zeros(rfunc.shape, dtype=np.complex128)
+    np.divide(xfunc + 1j * yfunc, rfunc, where=rfunc != 0.0, out=eulfunc)
+    chi = np.zeros((len(modes),) + rfunc.shape, dtype=np.complex128)
+    for i, (nn, mm) in enumerate(modes):
+        if nn < abs(mm) or (nn - mm) % 2 != 0:
+            raise ValueError("Do not support shapelet mode (%d, %d)" % (nn, mm))
+        c1 = (nn - abs(mm)) // 2
+        d1 = (nn + abs(mm)) // 2
+        # generalized Laguerre polynomial L_{c1}^{|m|}
+        lfunc0 = np.ones(rfunc.shape)
+        lfunc = 1.0 - r2_over_sigma2 + abs(mm)
+        if c1 == 0:
+            lfunc = lfunc0
+        for n in range(2, c1 + 1):
+            lfunc, lfunc0 = (2.0 + (abs(mm) - 1.0 - r2_over_sigma2) / n) * lfunc - (
+                1.0 + (abs(mm) - 1.0) / n
+            ) * lfunc0, lfunc
+        cc = math.factorial(c1) / math.factorial(d1)
+        chi[i] = (
+            pow(-1.0, d1)
+            * pow(cc, 0.5)
+            * lfunc
+            * r2_over_sigma2 ** (abs(mm) / 2)
+            * gaufunc
+            * eulfunc**mm
+            * (1j) ** nn
+        )
+    return chi / ngrid**2.0
 
 
 def shapelets2d(ngrid, nord, sigma, klim):
@@ -154,53 +240,15 @@ def shapelets2d(ngrid, nord, sigma, klim):
     Returns:
         chi (ndarray):  2d shapelet basis
     """
-
     mord = nord
-    gaufunc, (yfunc, xfunc) = _gauss_kernel_fft(
-        ngrid, ngrid, sigma, klim, return_grid=True
-    )
-    rfunc = np.sqrt(xfunc**2.0 + yfunc**2.0)  # radius
-    r2_over_sigma2 = (rfunc / sigma) ** 2.0
-    ny, nx = gaufunc.shape
-
-    rmask = rfunc != 0.0
-    xtfunc = np.zeros((ny, nx), dtype=np.float64)
-    ytfunc = np.zeros((ny, nx), dtype=np.float64)
-    np.divide(xfunc, rfunc, where=rmask, out=xtfunc)  # cos(phi)
-    np.divide(yfunc, rfunc, where=rmask, out=ytfunc)  # sin(phi)
-    eulfunc = xtfunc + 1j * ytfunc  # e^{jphi}
-    # Set up Laguerre function
-    lfunc = np.zeros((nord + 1, mord + 1, ny, nx), dtype=np.float64)
-    lfunc[0, :, :, :] = 1.0
-    lfunc[1, :, :, :] = 1.0 - r2_over_sigma2 + np.arange(mord + 1)[None, :, None, None]
-    #
-    chi = np.zeros((nord + 1, mord + 1, ny, nx), dtype=np.complex64)
-    for n in range(2, nord + 1):
-        for m in range(mord + 1):
-            lfunc[n, m, :, :] = (2.0 + (m - 1.0 - r2_over_sigma2) / n) * lfunc[
-                n - 1, m, :, :
-            ] - (1.0 + (m - 1.0) / n) * lfunc[n - 2, m, :, :]
-    for nn in range(nord + 1):
-        for mm in range(nn, -1, -2):
-            c1 = (nn - abs(mm)) // 2
-            d1 = (nn + abs(mm)) // 2
-            cc = math.factorial(c1) + 0.0
-            dd = math.factorial(d1) + 0.0
-            cc = cc / dd
-            chi[nn, mm, :, :] = (
-                pow(-1.0, d1)
-                * pow(cc, 0.5)
-                * lfunc[c1, abs(mm), :, :]
-                * pow(r2_over_sigma2, abs(mm) / 2)
-                * gaufunc
-                * eulfunc**mm
-                * (1j) ** nn
-            )
-    chi = chi.reshape(((nord + 1) ** 2, ny, nx)) / ngrid**2.0
+    modes = [(nn, mm) for nn in range(nord + 1) for mm in range(nn, -1, -2)]
+    chi = np.zeros((nord + 1, mord + 1, ngrid, ngrid), dtype=np.complex64)
+    chi[tuple(np.transpose(modes))] = shapelets2d_modes(ngrid, modes, sigma, klim)
+    chi = chi.reshape(((nord + 1) ** 2, ngrid, ngrid))
     return chi
 
 
-def shapelets2d_real(ngrid, nord, sigma, klim):
+def shapelets2d_real(ngrid, nord, sigma, klim, klim_pix=None):
     """Generates real shapelets function in Fourier space, chi00 are
     normalized to 1
     [only support square stamps: ny=nx=ngrid]
@@ -210,16 +258,16 @@ def shapelets2d_real(ngrid, nord, sigma, klim):
         nord (int):     radial order of the shaplets
         sigma (float):  scale of shapelets in Fourier space
         klim (float):   upper limit of |k|
+        klim_pix (int): only generate the pixels within klim_pix from the
+                        center on both axes [default: None, all pixels]
     Returns:
         chi_2 (ndarray): 2d shapelet basis w/ shape [n,ngrid,ngrid]
         name_s (list):   A list of shaplet names w/ shape [n]
 
     """
-    # nm = m*(nnord+1)+n
     if nord == 4:
         # This setup is for shear response only
         # Only uses M00, M20, M22 (real and img) and M40, M42
-        indm = np.array([0, 10, 12, 20, 22])[:, None, None]
         name_s = ["m00", "m20", "m22c", "m22s", "m40", "m42c", "m42s"]
         ind_s = [
             [0, False],
@@ -233,7 +281,6 @@ def shapelets2d_real(ngrid, nord, sigma, klim):
     elif nord == 6:
         # This setup is able to derive kappa response and shear response
         # Only uses M00, M20, M22 (real and img), M40, M42(real and img), M60
-        indm = np.array([0, 14, 16, 28, 30, 42])[:, None, None]
         name_s = ["m00", "m20", "m22c", "m22s", "m40", "m42c", "m42s", "m60"]
         ind_s = [
             [0, False],
@@ -252,19 +299,19 @@ def shapelets2d_real(ngrid, nord, sigma, klim):
             % nord
         )
     # generate the complex shaplet functions
-    chi = shapelets2d(ngrid, nord, sigma, klim)[indm]
+    chi = shapelets2d_modes(ngrid, shapelet_modes[nord], sigma, klim, klim_pix)
     # transform to real shapelet functions
-    chi_2 = np.zeros((len(name_s), ngrid, ngrid), dtype=np.float64)
+    chi_2 = np.zeros((len(name_s),) + chi.shape[1:], dtype=np.float64)
     for i, ind in enumerate(ind_s):
         if ind[1]:
-            chi_2[i] = np.float64(chi[ind[0]].imag)
+            chi_2[i] = chi[ind[0]].imag
         else:
-            chi_2[i] = np.float64(chi[ind[0]].real)
+            chi_2[i] = chi[ind[0]].real
     del chi
     return chi_2, name_s
 
 
-def fpfs_bases(ngrid, nord, sigma, sigma_det=None, klim=3.15):
+def fpfs_bases(ngrid, nord, sigma, sigma_det=None, klim=3.15, klim_pix=None):
     """Returns the FPFS bases (shapelets and detectlets)
 
     Args:
@@ -274,6 +321,9 @@ def fpfs_bases(ngrid, nord, sigma, sigma_det=None, klim=3.15):
         sigma (float):          shapelet kernel scale in Fourier space
         sigma_det (float):      detectlet kernel scale in Fourier space
         klim (float):           upper limit of |k| [default 3.15]
+        klim_pix (int):         only generate the pixels within klim_pix from
+                                the center on both axes [default: None, all
+                                pixels]
     """
     if sigma_det is None:
         sigma_det = sigma
@@ -282,42 +332,42 @@ def fpfs_bases(ngrid, nord, sigma, sigma_det=None, klim=3.15):
         nord,
         sigma,
         klim,
+        klim_pix=klim_pix,
     )
     psi = detlets2d(
         ngrid,
         sigma_det,
         klim,
+        klim_pix=klim_pix,
+    )
+    bnames = bnames + (
+        ["v%d" % i for i in range(8)]
+        + ["v%d_g1" % i for i in range(8)]
+        + ["v%d_g2" % i for i in range(8)]
     )
-    bnames = bnames + [
-        "v0",
-        "v1",
-        "v2",
-        "v3",
-        "v4",
-        "v5",
-        "v6",
-        "v7",
-        "v0_g1",
-        "v1_g1",
-        "v2_g1",
-        "v3_g1",
-        "v4_g1",
-        "v5_g1",
-        "v6_g1",
-        "v7_g1",
-        "v0_g2",
-        "v1_g2",
-        "v2_g2",
-        "v3_g2",
-        "v4_g2",
-        "v5_g2",
-        "v6_g2",
-        "v7_g2",
-    ]
     bfunc = np.vstack([bfunc, np.vstack(np.swapaxes(psi, 0, 1))])
     return bfunc, bnames
 
 
+def fpfs_bases_names(nord):
+    """Returns the names of the FPFS bases (see fpfs_bases)
+
+    Args:
+        nord (int):             the highest order of Shapelets radial
+                                components
+    Returns:
+        bnames (list):          names of the bases
+    """
+    bnames = ["m00", "m20", "m22c", "m22s", "m40", "m42c", "m42s"]
+    if nord == 6:
+        bnames = bnames + ["m60"]
+    return bnames + (
+        ["v%d" % i for i in range(8)]
+        + ["v%d_g1" % i for i in range(8)]
+        + ["v%d_g2" % i for i in range(8)]
+    )
+
+
 def fit_noise_pf(ngrid, gal_pow, noise_mod, rlim):
     """
     Fit the noise power from observed galaxy power
@@ -420,18 +470,60 @@ def find_peaks(img_conv, img_conv_det, thres, thres2=0.0, bound=20.0):
         coord_array (ndarray):      ndarray of coordinates [y,x]
     """
     sel = img_conv > thres
-    sel = get_pixel_detect_mask(sel, img_conv_det, thres2)
-    data = jnp.array(jnp.int_(jnp.asarray(jnp.where(sel))))
+    sel = get_pixel_detect_mask(sel, img_conv_det, float(thres2))
+    return get_mask_coords(sel, bound)
+
+
+def get_mask_coords(sel, bound=20.0):
+    """Returns the coordinates (y,x) of the selected pixels away from the
+    image boundary; the coordinates are extracted on the host, since their
+    number changes from image to image (see get_mask_coords_fixed for a
+    jittable version)
+
+    Args:
+        sel (ndarray):              selection mask
+        bound (float):              minimum distance to the image boundary
+    Returns:
+        coord_array (ndarray):      ndarray of coordinates [y,x]
+    """
+    sel = np.asarray(sel)
+    ny, nx = sel.shape
+    y, x = np.nonzero(sel)
     del sel
-    ny, nx = img_conv.shape
-    y = data[0]
-    x = data[1]
     msk = (y > bound) & (y < ny - bound) & (x > bound) & (x < nx - bound)
-    data = data[:, msk]
+    data = np.stack([y[msk], x[msk]]).astype(np.int64)
     return data
 
 
-@jax.jit
+@partial(jax.jit, static_argnames=["max_peaks"])
+def get_mask_coords_fixed(sel, bound, max_peaks):
+    """Returns the coordinates (y,x) of the selected pixels away from the
+    image boundary in an array with a fixed capacity (jitted), so that the
+    detection does not synchronize with the host
+
+    Args:
+        sel (ndarray):              selection mask
+        bound (float):              minimum distance to the image boundary
+        max_peaks (int):            capacity of the coordinate array
+    Returns:
+        coord_array (ndarray):      coordinates [y,x] in shape of
+                                    [max_peaks, 2]; the entries after the
+                                    valid ones are the image center
+        count (int):                number of valid coordinates
+        overflow (bool):            whether more than max_peaks pixels are
+                                    selected (the extra ones are dropped)
+    """
+    ny, nx = sel.shape
+    y = jnp.arange(ny)[:, None]
+    x = jnp.arange(nx)[None, :]
+    sel = sel & (y > bound) & (y < ny - bound) & (x > bound) & (x < nx - bound)
+    ntot = jnp.sum(sel)
+    data = jnp.nonzero(sel, size=max_peaks, fill_value=(ny // 2, nx // 2))
+    data = jnp.stack(data, axis=-1).astype(jnp.int_)
+    return data, jnp.minimum(ntot, max_peaks), ntot > max_peaks
+
+
+@partial(jax.jit, static_argnames=["klim"])
 def convolve2gausspsf(img_data, psf_data, sigmaf, klim):
     """This function convolves an image to transform the PSF to a Gaussian
 
@@ -444,10 +536,27 @@ def convolve2gausspsf(img_data, psf_data, sigmaf, klim):
     Returns:
         img_conv (ndarray):     the reconvolved image
     """
-
-    ny, nx = psf_data.shape
     # Fourier transform
     psf_fourier = jnp.fft.rfft2(jnp.fft.ifftshift(psf_data))
+    return convolve2gauss_fourier(img_data, psf_fourier, sigmaf, klim)
+
+
+@partial(jax.jit, static_argnames=["klim"])
+def convolve2gauss_fourier(img_data, psf_fourier, sigmaf, klim):
+    """This function convolves an image to transform the PSF to a Gaussian,
+    with the PSF given by its real Fourier transform (see get_psf_product)
+
+    Args:
+        img_data (ndarray):     image data
+        psf_fourier (ndarray):  rfft2 of the PSF (centered at the origin) in
+                                the shape of the image
+        sigmaf (float):         sigma of Gaussian
+        klim (float):           radius for masking in Fourier space
+
+    Returns:
+        img_conv (ndarray):     the reconvolved image
+    """
+    ny, nx = img_data.shape
     # Gaussian kernel
     gauss_kernel = _gauss_kernel_rfft(ny, nx, sigmaf, klim, return_grid=False)
     # convolved images
@@ -456,47 +565,440 @@ def convolve2gausspsf(img_data, psf_data, sigmaf, klim):
     return img_conv
 
 
-@jax.jit
-def get_klim(psf_array, sigma, thres=1e-20):
+@partial(jax.jit, static_argnames=["klim", "return_conv"])
+def get_detect_mask(
+    img_data,
+    psf_fourier,
+    sigmaf,
+    sigmaf_det,
+    klim,
+    thres,
+    thres2,
+    return_conv=False,
+    mask=None,
+    min_weight=0.5,
+):
+    """Returns the detection mask of peaks; the image is transformed once and
+    convolved with the two Gaussian kernels (for the threshold and for the
+    peak identification) in Fourier space, and the mask is computed in the
+    same compiled program (see find_peaks). With a mask plane, the image is
+    convolved with normalized convolution, i.e., the convolution of the
+    unmasked pixels divided by the convolved weight of the unmasked pixels
+
+    Args:
+        img_data (ndarray):     image data
+        psf_fourier (ndarray):  rfft2 of the PSF (centered at the origin) in
+                                the shape of the image
+        sigmaf (float):         sigma of Gaussian for the threshold
+        sigmaf_det (float):     sigma of Gaussian for the peak identification
+        klim (float):           radius for masking in Fourier space
+        thres (float):          detection threshold
+        thres2 (float):         peak identification difference threshold
+        return_conv (bool):     whether also return the image convolved with
+                                the threshold kernel [default: False]
+        mask (ndarray):         mask plane, nonzero for the masked pixels
+                                [default: None]
+        min_weight (float):     no detection on masked pixels, or pixels
+                                whose convolved weight is below min_weight
+                                [default: 0.5]
+
+    Returns:
+        sel (ndarray):          mask of the peaks
+        img_conv (ndarray):     the convolved image [if return_conv]
+    """
+    ny, nx = img_data.shape
+    gauss_kernels = jnp.stack(
+        [
+            _gauss_kernel_rfft(ny, nx, sigmaf, klim, return_grid=False),
+            _gauss_kernel_rfft(ny, nx, sigmaf_det, klim, return_grid=False),
+        ]
+    )
+    if mask is None:
+        img_fourier = jnp.fft.rfft2(img_data) / psf_fourier
+        img_conv, img_conv_det = jnp.fft.irfft2(
+            img_fourier * gauss_kernels, (ny, nx)
+        )
+        sel = img_conv > thres
+    else:
+        weight = jnp.where(mask != 0, 0.0, 1.0)
+        img_fourier = jnp.fft.rfft2(jnp.stack([img_data * weight, weight]))
+        img_fourier = img_fourier / psf_fourier
+        convs = jnp.fft.irfft2(img_fourier[:, None] * gauss_kernels, (ny, nx))
+        # the kernels are normalized to the PSF flux
+        wconvs = convs[1] * jnp.real(psf_fourier[0, 0])
+        valid = jnp.all(wconvs > min_weight, axis=0) & (weight > 0.0)
+        img_conv = jnp.where(valid, convs[0, 0] / wconvs[0], 0.0)
+        # a pixel next to an invalid pixel is not identified as a peak
+        img_conv_det = jnp.where(valid, convs[0, 1] / wconvs[1], jnp.inf)
+        sel = valid & (img_conv > thres)
+    sel = get_pixel_detect_mask(sel, img_conv_det, thres2)
+    if return_conv:
+        return sel, img_conv
+    return sel
+
+
+@partial(jax.jit, static_argnames=["klim", "max_peaks", "chunk_size"])
+def get_detect_modes(
+    img_data,
+    psf_fourier,
+    kernels,
+    sigmaf,
+    sigmaf_det,
+    klim,
+    thres,
+    thres2,
+    bound,
+    max_peaks,
+    chunk_size=256,
+):
+    """Detects peaks and measures the M00, M20 and v modes of the peaks
+    (jitted), with a fixed capacity of peaks (see get_mask_coords_fixed). M00
+    and the v modes along the axes are sampled from the convolved images of
+    the detection, and the other modes are measured with the real-space
+    kernels on the pixels around the peaks; the modes are not normalized by
+    the pixel area
+
+    Args:
+        img_data (ndarray):     image data
+        psf_fourier (ndarray):  rfft2 of the PSF (centered at the origin) in
+                                the shape of the image
+        kernels (ndarray):      real-space kernels of M20 and of the v modes
+                                along the diagonals (v1, v3, v5, v7) in
+                                shape of [5, 2r+1, 2r+1], see
+                                measure_source.get_detect_kernels
+        sigmaf (float):         sigma of Gaussian for the threshold
+        sigmaf_det (float):     sigma of Gaussian for the peak identification
+        klim (float):           radius for masking in Fourier space
+        thres (float):          detection threshold
+        thres2 (float):         peak identification difference threshold
+        bound (float):          minimum distance to the image boundary
+        max_peaks (int):        capacity of the coordinate array, a multiple
+                                of chunk_size
+        chunk_size (int):       number of peaks measured with the kernels in
+                                one vectorized call [default: 256]
+
+    Returns:
+        coord_array (ndarray):  coordinates [y,x] in shape of [max_peaks, 2]
+        modes (ndarray):        M00, M20 and v0 - v7 [max_peaks, 10]
+        count (int):            number of valid coordinates
+        overflow (bool):        whether more than max_peaks peaks are found
+    """
+    ny, nx = img_data.shape
+    gauss_kernels = jnp.stack(
+        [
+            _gauss_kernel_rfft(ny, nx, sigmaf, klim, return_grid=False),
+            _gauss_kernel_rfft(ny, nx, sigmaf_det, klim, return_grid=False),
+        ]
+    )
+    img_fourier = jnp.fft.rfft2(img_data) / psf_fourier
+    img_conv, img_conv_det = jnp.fft.irfft2(img_fourier * gauss_kernels, (ny, nx))
+    sel = get_pixel_detect_mask(img_conv > thres, img_conv_det, thres2)
+    coords, count, overflow = get_mask_coords_fixed(sel, bound, max_peaks)
+    y, x = coords[:, 0], coords[:, 1]
+    cdet = img_conv_det[y, x]
+    # v_i = c(x) - c(x + d_i), where c is the image convolved with the
+    # detection kernel
+    vaxis = [
+        cdet - img_conv_det[(y + dy) % ny, (x + dx) % nx]
+        for dy, dx in [(0, 1), (1, 0), (0, -1), (-1, 0)]
+    ]
+
+    rr = jnp.arange(kernels.shape[-1]) - kernels.shape[-1] // 2
+
+    def _measure(ic, out):
+        cc = jax.lax.dynamic_slice_in_dim(coords, ic * chunk_size, chunk_size)
+        rows = (cc[:, 0, None] + rr) % ny
+        cols = (cc[:, 1, None] + rr) % nx
+        stamps = img_data[rows[:, :, None], cols[:, None, :]]
+        mm = jnp.einsum("kij,nij->nk", kernels, stamps)
+        return jax.lax.dynamic_update_slice_in_dim(out, mm, ic * chunk_size, axis=0)
+
+    out = jnp.zeros((max_peaks, kernels.shape[0]), dtype=img_data.dtype)
+    out = jax.lax.fori_loop(0, -(-count // chunk_size), _measure, out)
+    vdiag = [cdet - out[:, 1 + i] for i in range(4)]
+    vv = [vv for pair in zip(vaxis, vdiag) for vv in pair]
+    modes = jnp.stack([img_conv[y, x], out[:, 0]] + vv)
+    return coords, modes.T, count, overflow
+
+
+def remove_close_peaks(coords, values, min_sep):
+    """Removes the peaks within min_sep pixels of a brighter peak; the peaks
+    are visited from the brightest one, and compared to the kept peaks in the
+    neighboring cells of a grid with cell size min_sep, so the cost is linear
+    in the number of peaks
+
+    Args:
+        coords (ndarray):           coordinates of peaks [y,x]
+        values (ndarray):           brightness of peaks
+        min_sep (float):            minimum separation between peaks [pixel]
+    Returns:
+        keep (ndarray):             mask of the kept peaks
+    """
+    coords = np.asarray(coords)
+    if min_sep <= 0.0 or len(coords) < 2:
+        return np.ones(len(coords), dtype=bool)
+    yy, xx = coords[:, 0].tolist(), coords[:, 1].tolist()
+    cells = np.floor_divide(coords, min_sep).astype(int).tolist()
+    sep2 = min_sep**2.0
+    grid = {}
+    keep = np.zeros(len(coords), dtype=bool)
+    for i in np.argsort(-np.asarray(values), kind="stable").tolist():
+        cy, cx = cells[i]
+        close = any(
+            (yy[j] - yy[i]) ** 2 + (xx[j] - xx[i]) ** 2 < sep2
+            for dy in (-1, 0, 1)
+            for dx in (-1, 0, 1)
+            for j in grid.get((cy + dy, cx + dx), ())
+        )
+        if not close:
+            keep[i] = True
+            grid.setdefault((cy, cx), []).append(i)
+    return keep
+
+
+def pad_psf(psf_data, shape):
+    """Pads a PSF image with zeros to shape; the center pixel of the PSF
+    (at psf_data.shape // 2) is moved to shape // 2
+
+    Args:
+        psf_data (ndarray):     PSF image
+        shape (tuple):          output shape
+    Returns:
+        out (ndarray):          padded PSF image
+    """
+    pad_width = []
+    for nn, mm in zip(shape, psf_data.shape):
+        if nn < mm:
+            raise ValueError(
+                "Cannot pad PSF of shape %s to %s" % (psf_data.shape, shape)
+            )
+        beg = nn // 2 - mm // 2
+        pad_width.append((beg, nn - mm - beg))
+    return np.pad(psf_data, pad_width, mode="constant")
+
+
+def _get_cached_array(cache, max_bytes, key, fname, compute):
+    """Returns an array from an in-memory LRU cache, or from an on-disk npy
+    store, or computes it (and saves it to the store); the arrays from the
+    store are returned as read-only memory maps, so the processes sharing the
+    store share the pages of the file
+
+    Args:
+        cache (OrderedDict):    in-memory cache
+        max_bytes (int):        limit of the total size of the arrays in the
+                                in-memory cache; the least recently used
+                                arrays are evicted, but the last one is
+                                always kept
+        key (tuple):            key of the array
+        fname (str):            file name in the on-disk store [None, no store]
+        compute (function):     function computing the array
+    Returns:
+        out (ndarray):          the array
+    """
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    if fname is None:
+        out = np.asarray(compute())
+    else:
+        if not os.path.isfile(fname):
+            # write and rename, since several processes may share the store
+            tmp_fname = "%s.%d.tmp.npy" % (fname[:-4], os.getpid())
+            np.save(tmp_fname, np.asarray(compute()))
+            os.replace(tmp_fname, fname)
+        out = np.load(fname, mmap_mode="r")
+    cache[key] = out
+    # the most recent array is kept even if it is larger than max_bytes, so
+    # repeated calls (e.g., detection on large exposures) do not recompute it
+    while len(cache) > 1 and sum(vv.nbytes for vv in cache.values()) > max_bytes:
+        cache.popitem(last=False)
+    return out
+
+
+# PSF products keyed by (PSF hash, kind, shape), see get_psf_product
+_psf_product_cache = OrderedDict()
+# limit of the total size of the PSF products cached in memory [bytes]
+psf_product_cache_bytes = 2**28
+# directory of the on-disk (npy) store of the PSF products, which is shared by
+# processes [default: None, not used]; see fpfs.cache.enable_psf_cache
+psf_product_dir = None
+
+
+def _compute_psf_product(psf_data, kind):
+    # computed with numpy, so that new PSFs and shapes do not compile programs
+    if kind == "pad":
+        return psf_data
+    elif kind == "fft":
+        return np.fft.fftshift(np.fft.fft2(psf_data))
+    elif kind == "pow":
+        return np.fft.fftshift(np.abs(np.fft.fft2(psf_data)) ** 2.0)
+    elif kind == "rfft":
+        return np.fft.rfft2(np.fft.ifftshift(psf_data))
+    raise ValueError("Do not support PSF product: %s" % kind)
+
+
+def get_psf_product(psf_data, kind, shape=None):
+    """Returns a product of a PSF image, which is cached by the content of the
+    PSF, the kind and the shape of the product (in memory, and on disk if
+    psf_product_dir is set, where it is memory-mapped); the in-memory cache is
+    bounded by psf_product_cache_bytes, but always keeps the last product
+
+    Args:
+        psf_data (ndarray):     PSF image (centered at psf_data.shape // 2)
+        kind (str):             "pad" (PSF padded to shape), "fft" (shifted
+                                fft2 as measure_base.psf_fourier), "pow"
+                                (shifted Fourier power) or "rfft" (rfft2 with
+                                the PSF center moved to the origin)
+        shape (tuple):          shape of the padded PSF [default: None, the
+                                shape of psf_data]
+    Returns:
+        out (ndarray):          the PSF product
+    """
+    psf_data = np.asarray(psf_data, dtype=np.float64)
+    if shape is None:
+        shape = psf_data.shape
+    shape = tuple(int(nn) for nn in shape)
+    key = (array_hash(psf_data), kind, shape)
+    fname = None
+    if psf_product_dir is not None:
+        fname = os.path.join(
+            psf_product_dir,
+            "%s_%s_%s.npy" % (key[0], kind, "x".join(str(nn) for nn in shape)),
+        )
+    return _get_cached_array(
+        _psf_product_cache,
+        psf_product_cache_bytes,
+        key,
+        fname,
+        lambda: _compute_psf_product(pad_psf(psf_data, shape), kind),
+    )
+
+
+# bases keyed by their configuration
+_basis_cache = OrderedDict()
+# limit of the total size of the bases cached in memory [bytes]
+basis_cache_bytes = 2**27
+# directory of the on-disk (npy) store of the bases, which is shared by
+# processes [default: None, not used]; see fpfs.cache.enable_basis_cache
+basis_dir = None
+
+
+def _compute_basis(name, ngrid, nord, sigma, klim, sigma_det, klim_pix):
+    # the bases are only generated on the pixels within klim_pix
+    if name == "chi":
+        return shapelets2d_modes(ngrid, shapelet_modes[nord], sigma, klim, klim_pix)
+    elif name == "psi":
+        return detlets2d(ngrid, sigma, klim, dtype=np.complex128, klim_pix=klim_pix)
+    elif name == "bfunc":
+        return fpfs_bases(ngrid, nord, sigma, sigma_det, klim, klim_pix)[0]
+    raise ValueError("Do not support basis: %s" % name)
+
+
+def get_basis(name, ngrid, nord, sigma, klim, sigma_det=None, klim_pix=None):
+    """Returns the bases truncated to the pixels within klim_pix, which are
+    cached by the configuration (in memory, and on disk if basis_dir is set,
+    so that they are only computed once by the processes sharing the store)
+
+    Args:
+        name (str):             "chi" (complex shapelets of the shapelet_modes
+                                of nord), "psi" (detlets2d) or "bfunc" (the
+                                first output of fpfs_bases)
+        ngrid (int):            stamp size
+        nord (int):             the highest order of Shapelets radial
+                                components
+        sigma (float):          shapelet (detectlet for psi) kernel scale in
+                                Fourier space
+        klim (float):           upper limit of |k|
+        sigma_det (float):      detectlet kernel scale in Fourier space of
+                                bfunc [default: None]
+        klim_pix (int):         the bases are truncated to the pixels within
+                                klim_pix from the center on both axes
+                                [default: None, not truncated]
+    Returns:
+        out (ndarray):          the bases
+    """
+    key = (
+        name,
+        int(ngrid),
+        int(nord),
+        float(sigma),
+        float(klim),
+        None if sigma_det is None else float(sigma_det),
+        None if klim_pix is None else int(klim_pix),
+    )
+    fname = None
+    if basis_dir is not None:
+        fname = os.path.join(
+            basis_dir,
+            "%s_%s.npy" % (name, hashlib.sha1(repr(key).encode()).hexdigest()[:16]),
+        )
+    return _get_cached_array(
+        _basis_cache,
+        basis_cache_bytes,
+        key,
+        fname,
+        lambda: _compute_basis(*key),
+    )
+
+
+# klim keyed by (PSF hash, sigma, thres, azimuth)
+_klim_cache = {}
+klim_cache_size = 256
+
+
+def get_klim(psf_array, sigma, thres=1e-20, azimuth=False):
     """Gets klim, the region outside klim is supressed by the shaplet Gaussian
     kernel in FPFS shear estimation method; therefore we set values in this
-    region to zeros
+    region to zeros. The ratio between the Gaussian and the PSF is evaluated
+    on the radial profile in one shot, and klim is the first radius (starting
+    from ngrid // 5) where the ratio falls to thres; the result is memoized by
+    the content of the PSF array, sigma and thres.
 
     Args:
         psf_array (ndarray):    PSF's Fourier power or Fourier transform
+                                (shifted, origin at ngrid // 2)
         sigma (float):          one sigma of Gaussian Fourier power
         thres (float):          the threshold for a tuncation on Gaussian
                                 [default: 1e-20]
+        azimuth (bool):         if True, the ratio should fall to thres in all
+                                directions at klim, which is safer for
+                                elongated PSFs; otherwise the ratio is only
+                                checked on the two principal axes (the one
+                                with smaller ratio is used) [default: False]
     Returns:
-        klim (float):           the limit radius
+        klim (int):             the limit radius [at most ngrid // 2]
     """
+    psf_array = np.abs(np.asarray(psf_array))
+    key = (array_hash(psf_array), float(sigma), float(thres), bool(azimuth))
+    if key in _klim_cache:
+        return _klim_cache[key]
     ngrid = psf_array.shape[0]
-
-    def cond_fun(dist):
-        v1 = abs(
-            jnp.exp(-(dist**2.0) / 2.0 / sigma**2.0)
-            / psf_array[ngrid // 2 + dist, ngrid // 2]
-        )
-        v2 = abs(
-            jnp.exp(-(dist**2.0) / 2.0 / sigma**2.0)
-            / psf_array[ngrid // 2, ngrid // 2 + dist]
-        )
-        return jax.lax.cond(
-            v1 < v2,
-            v1,
-            lambda x: x > thres,
-            v2,
-            lambda x: x > thres,
-        )
-
-    def body_fun(dist):
-        return dist + 1
-
-    klim = jax.lax.while_loop(
-        cond_fun=cond_fun,
-        body_fun=body_fun,
-        init_val=ngrid // 5,
-    )
+    cc = ngrid // 2
+    dist = np.arange(ngrid // 5, cc)
+    with np.errstate(divide="ignore"):
+        if azimuth:
+            ky, kx = np.meshgrid(
+                np.arange(ngrid) - cc, np.arange(ngrid) - cc, indexing="ij"
+            )
+            rr = np.hypot(ky, kx)
+            ring = np.rint(rr).astype(int)
+            msk = ring < cc
+            ratio = np.exp(-(rr[msk] ** 2.0) / 2.0 / sigma**2.0) / psf_array[msk]
+            # the largest ratio on each ring
+            prof = np.zeros(cc)
+            np.maximum.at(prof, ring[msk], ratio)
+            prof = prof[dist]
+        else:
+            gauss = np.exp(-(dist**2.0) / 2.0 / sigma**2.0)
+            prof = np.minimum(
+                gauss / psf_array[cc + dist, cc],
+                gauss / psf_array[cc, cc + dist],
+            )
+    ind = np.flatnonzero(prof <= thres)
+    klim = int(dist[ind[0]]) if len(ind) > 0 else cc
+    if len(_klim_cache) >= klim_cache_size:
+        _klim_cache.pop(next(iter(_klim_cache)))
+    _klim_cache[key] = klim
     return klim
 
 
@@ -523,3 +1025,18 @@ def truncate_circle(arr, rcut):
     # Mask values outside the circle
     arr[distance_squared > rcut**2] = 0.0
     return
+
+
+def array_hash(arr):
+    """Returns the content hash of an array (including shape and dtype)
+
+    Args:
+        arr (ndarray):      input array
+    Returns:
+        out (str):          hex digest
+    """
+    arr = np.ascontiguousarray(arr)
+    hh = hashlib.sha1()
+    hh.update(str((arr.shape, arr.dtype.str)).encode())
+    hh.update(arr.tobytes())
+    return hh.hexdigest()
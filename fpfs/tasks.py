@@ -225,6 +225,8 @@ class ProcessSimulationTask(object):
         self.img_dir = cparser.get("files", "img_dir")
         self.cat_dir = cparser.get("files", "cat_dir")
         self.psf_file_name = cparser.get("files", "psf_file_name")
+        self.psf_array = None
+        fpfs.cache.enable_caches(cparser, "files")
         if not os.path.isdir(self.img_dir):
             raise FileNotFoundError("Cannot find input images directory!")
         logging.info("The input directory for galaxy images is %s. " % self.img_dir)
@@ -239,6 +241,17 @@ class ProcessSimulationTask(object):
         self.psf_rcut = cparser.getint("FPFS", "psf_rcut", fallback=22)
         self.psf_rcut = min(self.psf_rcut, self.rcut)
         self.nnord = cparser.getint("FPFS", "nnord", fallback=4)
+        # number of sources measured in one vectorized call
+        self.chunk_size = cparser.getint("FPFS", "chunk_size", fallback=256)
+        # detect in tiles of this size on large exposures [0: whole exposure]
+        self.detect_tile_size = cparser.getint("FPFS", "detect_tile_size", fallback=0)
+        # only keep the brightest peak within min_sep pixels [0: keep all]
+        self.min_sep = cparser.getfloat("FPFS", "min_sep", fallback=0.0)
+        # pre-select sources with the modes measured in detection
+        self.preselect = cparser.getboolean("FPFS", "preselect", fallback=False)
+        # initial capacity of the pre-selected sources (in each tile), which
+        # is doubled if more sources are detected
+        self.max_peaks = cparser.getint("FPFS", "max_peaks", fallback=16384)
         if self.nnord not in [4, 6]:
             raise ValueError(
                 "Only support for nnord= 4 or nnord=6, but your input\
@@ -259,6 +272,8 @@ class ProcessSimulationTask(object):
         self.magz = cparser.getfloat("survey", "mag_zero")
         self.band = cparser.get("survey", "band")
         self.scale = cparser.getfloat("survey", "pixel_scale")
+        # image size (only used to compile ahead of time)
+        self.image_nx = cparser.getint("simulation", "image_nx", fallback=None)
         ngrid = 2 * self.rcut
         # By default, we use uncorrelated noise
         # TODO: enable correlated noise here
@@ -280,13 +295,19 @@ class ProcessSimulationTask(object):
             assert os.path.isfile(rr), "file %s does not exist" % rr
         return refs
 
+    def prepare_psf(self):
+        # the PSF is read once; its Fourier transforms (and the padded PSF
+        # for detection) are cached by fpfs.imgutil.get_psf_product
+        if self.psf_array is None:
+            psf_array = np.asarray(pyfits.getdata(self.psf_file_name), dtype="<f8")
+            fpfs.imgutil.truncate_square(psf_array, self.psf_rcut)
+            self.psf_array = psf_array
+        return self.psf_array
+
     def prepare_noise_psf(self, fname):
         exposure = pyfits.getdata(fname)
         self.image_nx = exposure.shape[1]
-        psf_array = pyfits.getdata(self.psf_file_name)
-        fpfs.imgutil.truncate_square(psf_array, self.psf_rcut)
-        npad = (self.image_nx - psf_array.shape[0]) // 2
-        psf_array2 = np.pad(psf_array, (npad, npad), mode="constant")
+        psf_array = self.prepare_psf()
         if not os.path.isfile(self.ncov_fname):
             # FPFS noise cov task
             noise_task = fpfs.image.measure_noise_cov(
@@ -303,7 +324,7 @@ class ProcessSimulationTask(object):
         assert np.all(
             np.diagonal(cov_elem) > 1e-10
         ), "The covariance matrix is incorrect"
-        return psf_array, psf_array2, cov_elem
+        return psf_array, cov_elem
 
     def prepare_image(self, fname):
         gal_array = np.zeros((self.image_nx, self.image_nx))
@@ -323,15 +344,46 @@ class ProcessSimulationTask(object):
             logging.info("Using noiseless setup")
         return gal_array
 
-    def process_image(self, gal_array, psf_array, psf_array2, cov_elem):
-        # measurement task
-        meas_task = fpfs.image.measure_source(
+    def get_meas_task(self, psf_array):
+        # measurement task (cached, so it only compiles once per worker)
+        meas_task = fpfs.cache.get_measure_source(
             psf_array,
             sigma_arcsec=self.sigma_as,
             sigma_detect=self.sigma_det,
             nnord=self.nnord,
             pix_scale=self.scale,
         )
+        return meas_task
+
+    def warmup(self, image_nx=None):
+        """Compiles ahead of time the detection and measurement functions for
+        the images of the configuration, by running them on a noise image
+        with the detection options of the configuration
+
+        Args:
+            image_nx (int):     image size [default: None, image_nx of the
+                                simulation in the configuration]
+        """
+        if image_nx is None:
+            image_nx = self.image_nx
+        if image_nx is None:
+            raise ValueError("Cannot find the image size for warming up")
+        psf_array = self.prepare_psf()
+        meas_task = self.get_meas_task(psf_array)
+        fpfs.cache.compile_measure_source(
+            meas_task,
+            image_shape=(image_nx, image_nx),
+            chunk_size=self.chunk_size,
+            psf_data=psf_array,
+            tile_size=self.detect_tile_size or None,
+            min_sep=self.min_sep or None,
+            preselect=self.preselect,
+            max_peaks=self.max_peaks,
+        )
+        return
+
+    def process_image(self, gal_array, psf_array, cov_elem):
+        meas_task = self.get_meas_task(psf_array)
 
         std_modes = np.sqrt(np.diagonal(cov_elem))
         idm00 = fpfs.catalog.indexes["m00"]
@@ -341,15 +393,41 @@ class ProcessSimulationTask(object):
             idv0 += 1
         thres = 9.5 * std_modes[idm00] * self.scale**2.0
         thres2 = -1.5 * std_modes[idv0] * self.scale**2.0
-        coords = meas_task.detect_sources(
-            img_data=gal_array,
-            psf_data=psf_array2,
-            thres=thres,
-            thres2=thres2,
-            bound=self.rcut + 5,
-        )
+        if self.preselect:
+            coords, out = meas_task.detect_modes(
+                img_data=gal_array,
+                psf_data=psf_array,
+                thres=thres,
+                thres2=thres2,
+                bound=self.rcut + 5,
+                max_peaks=self.max_peaks,
+                chunk_size=self.chunk_size,
+                min_sep=self.min_sep or None,
+                tile_size=self.detect_tile_size or None,
+            )
+            logging.info("detected number of sources: %d" % len(coords))
+            coords = coords[(out["fpfs_M00"] + out["fpfs_M20"]) > 0.0]
+        elif self.detect_tile_size > 0:
+            coords = meas_task.detect_sources_tiled(
+                img_data=gal_array,
+                psf_data=psf_array,
+                thres=thres,
+                thres2=thres2,
+                bound=self.rcut + 5,
+                tile_size=self.detect_tile_size,
+                min_sep=self.min_sep or None,
+            )
+        else:
+            coords = meas_task.detect_sources(
+                img_data=gal_array,
+                psf_data=psf_array,
+                thres=thres,
+                thres2=thres2,
+                bound=self.rcut + 5,
+                min_sep=self.min_sep or None,
+            )
         logging.info("pre-selected number of sources: %d" % len(coords))
-        out = meas_task.measure(gal_array, coords)
+        out = meas_task.measure(gal_array, coords, chunk_size=self.chunk_size)
         out = meas_task.get_results(out)
         sel = (out["fpfs_M00"] + out["fpfs_M20"]) > 0.0
         out = out[sel]
@@ -374,11 +452,11 @@ class ProcessSimulationTask(object):
         if os.path.isfile(out_fname) and os.path.isfile(det_fname):
             logging.info("Already has measurement for simulation: %s." % fname)
             return
-        psf_array, psf_array2, cov_elem = self.prepare_noise_psf(fname)
+        psf_array, cov_elem = self.prepare_noise_psf(fname)
         gal_array = self.prepare_image(fname)
         start_time = time.time()
-        cat, det = self.process_image(gal_array, psf_array, psf_array2, cov_elem)
-        del gal_array, psf_array, psf_array2, cov_elem
+        cat, det = self.process_image(gal_array, psf_array, cov_elem)
+        del gal_array, psf_array, cov_elem
         # Stop the timer
         end_time = time.time()
         # Calculate the elapsed time
@@ -0,0 +1,530 @@
+import jax
+import fpfs
+import galsim
+import logging
+import numpy as np
+
+
+def simulate_gal_psf(scale, seed, rcut, ny=128, nx=256):
+    psf_obj = galsim.Moffat(beta=3.5, fwhm=0.6, trunc=0.6 * 4.0).shear(
+        e1=0.02, e2=-0.02
+    )
+    psf_data = (
+        psf_obj.shift(0.5 * scale, 0.5 * scale)
+        .drawImage(nx=64, ny=64, scale=scale)
+        .array
+    )
+    psf_data = psf_data[32 - rcut : 32 + rcut, 32 - rcut : 32 + rcut]
+
+    rng = np.random.RandomState(seed)
+    gal_data = np.zeros((ny, nx))
+    indx = np.arange(32, nx, 64)
+    indy = np.arange(32, ny, 64)
+    inds = np.meshgrid(indy, indx, indexing="ij")
+    coords = np.vstack([inds[0].ravel(), inds[1].ravel()]).T
+    for yc, xc in coords:
+        gal_obj = galsim.Exponential(
+            half_light_radius=rng.uniform(0.2, 0.6),
+            flux=100.0,
+        ).shear(e1=rng.uniform(-0.3, 0.3), e2=rng.uniform(-0.3, 0.3))
+        gal_obj = galsim.Convolve(psf_obj, gal_obj).shift(0.5 * scale, 0.5 * scale)
+        gal_data[yc - 32 : yc + 32, xc - 32 : xc + 32] = gal_obj.drawImage(
+            nx=64, ny=64, scale=scale
+        ).array
+    return gal_data, psf_data, coords
+
+
+def test_chunked_measure():
+    scale = 0.2
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 1, 16)
+    for kwargs in [{}, {"use_rfft": True}, {"kernel_rcut": 12}]:
+        fpfs_task = fpfs.image.measure_source(
+            psf_data,
+            sigma_arcsec=0.55,
+            sigma_detect=0.5,
+            pix_scale=scale,
+            **kwargs,
+        )
+        mms = np.array(fpfs_task.measure(gal_data, coords))
+        # the projection is a matrix product, whose summation order may depend
+        # on the number of sources; so the results agree up to round-off
+        for chunk_size in [1, 3, len(coords)]:
+            mms2 = np.array(
+                fpfs_task.measure(gal_data, coords, chunk_size=chunk_size)
+            )
+            np.testing.assert_allclose(mms, mms2, rtol=1e-12, atol=1e-12)
+        mms2 = np.array(fpfs_task.measure(gal_data, coords, max_memory=1.0))
+        np.testing.assert_allclose(mms, mms2, rtol=1e-12, atol=1e-12)
+    return
+
+
+def test_rfft_measure():
+    scale = 0.2
+    for rcut in [16, 32]:
+        gal_data, psf_data, coords = simulate_gal_psf(scale, 2, rcut)
+        task = fpfs.image.measure_source(
+            psf_data,
+            sigma_arcsec=0.55,
+            sigma_detect=0.5,
+            pix_scale=scale,
+        )
+        task2 = fpfs.image.measure_source(
+            psf_data,
+            sigma_arcsec=0.55,
+            sigma_detect=0.5,
+            pix_scale=scale,
+            use_rfft=True,
+        )
+        mms = task.get_results(task.measure(gal_data, coords))
+        mms2 = task2.get_results(task2.measure(gal_data, coords))
+        for nn in mms.dtype.names:
+            np.testing.assert_allclose(mms[nn], mms2[nn], rtol=1e-10, atol=1e-10)
+    return
+
+
+def test_mode_subset():
+    scale = 0.2
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 3, 16)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    modes = ["fpfs_M00", "fpfs_M20"] + ["fpfs_v%d" % i for i in range(8)]
+    task2 = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+        modes=modes,
+    )
+    mms = task.get_results(task.measure(gal_data, coords))
+    mms2 = task2.get_results(task2.measure(gal_data, coords))
+    assert mms2.dtype.names == tuple(modes)
+    for nn in modes:
+        np.testing.assert_allclose(mms[nn], mms2[nn], rtol=1e-10, atol=1e-10)
+    return
+
+
+def test_kernel_measure():
+    scale = 0.2
+    rcut = 16
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 4, rcut)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    mms = np.array(task.measure(gal_data, coords))
+    # untruncated kernels are exact
+    task2 = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+        kernel_rcut=rcut,
+    )
+    mms2 = np.array(task2.measure(gal_data, coords, chunk_size=3))
+    np.testing.assert_allclose(mms, mms2, rtol=1e-10, atol=1e-10)
+    # the measurements with other PSFs use the per-stamp Fourier transforms,
+    # whose temporaries are larger than the truncated stamps
+    nn = task2.get_chunk_size(max_memory=1.0)
+    nn2 = task2.get_chunk_size(max_memory=1.0, use_kernels=False)
+    assert nn2 == task.get_chunk_size(max_memory=1.0)
+    assert nn2 < nn
+    return
+
+
+def test_dense_measure():
+    scale = 0.2
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 5, 16)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    mms = np.array(task.measure(gal_data, coords))
+    mms2 = np.array(task.measure_dense(gal_data, coords))
+    np.testing.assert_allclose(mms, mms2, rtol=1e-10, atol=1e-10)
+    return
+
+
+def test_float32_measure():
+    scale = 0.2
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 6, 16)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    task2 = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+        precision="float32",
+    )
+    mms = np.array(task.measure(gal_data, coords))
+    mms2 = task2.measure(gal_data, coords)
+    assert mms2.dtype == np.float32
+    np.testing.assert_allclose(mms, mms2, atol=1e-5 * np.max(np.abs(mms)))
+    return
+
+
+def test_edge_measure():
+    scale = 0.2
+    rcut = 16
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 7, rcut)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    coords2 = np.vstack([coords, [[3, 5], [120, 250], [60, 2]]])
+    flags = task.get_edge_flags(coords2, gal_data.shape)
+    np.testing.assert_array_equal(flags, [False] * len(coords) + [True] * 3)
+    mms = np.array(task.measure(gal_data, coords2, edge_mode="constant"))
+    gal_data2 = np.pad(gal_data, rcut)
+    mms2 = np.array(task.measure(gal_data2, coords2 + rcut))
+    np.testing.assert_allclose(mms, mms2, rtol=1e-10, atol=1e-10)
+    mms3 = np.array(task.measure(gal_data, coords))
+    np.testing.assert_allclose(mms[: len(coords)], mms3, rtol=1e-10, atol=1e-10)
+    return
+
+
+def test_psf_field_measure():
+    scale = 0.2
+    rcut = 16
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 8, rcut)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    # PSF grid of 2 x 4 cells with a different amplitude in each cell
+    amps = 1.0 + 0.1 * np.arange(8).reshape((2, 4, 1, 1))
+    psf_field = psf_data[None, None] * amps
+    mms = np.array(task.measure_psf_field(gal_data, coords, psf_field, 64))
+    mms2 = np.array(task.measure(gal_data, coords))
+    cells = coords // 64
+    np.testing.assert_allclose(
+        mms * amps[cells[:, 0], cells[:, 1], 0],
+        mms2,
+        rtol=1e-10,
+        atol=1e-10,
+    )
+    # the PSF field can also be a function of position
+    mms3 = np.array(
+        task.measure_psf_field(
+            gal_data,
+            coords,
+            lambda y, x: psf_field[int(y // 64), int(x // 64)],
+            64,
+            chunk_size=2,
+        )
+    )
+    np.testing.assert_allclose(mms, mms3, rtol=1e-10, atol=1e-10)
+    return
+
+
+def test_epoch_measure():
+    scale = 0.2
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 9, 16)
+    gal_data2 = simulate_gal_psf(scale, 10, 16)[0]
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    mms = np.array(task.measure(gal_data, coords))
+    mms2 = np.array(task.measure(gal_data2, coords))
+    # the second epoch has a twice brighter PSF, and the mode variances are
+    # proportional to noise_var / psf**2
+    out, out_comb = task.measure_epochs(
+        np.stack([gal_data, gal_data2 * 2.0]),
+        np.stack([psf_data, psf_data * 2.0]),
+        coords,
+        noise_var=[1.0, 12.0],
+        chunk_size=4,
+    )
+    np.testing.assert_allclose(out[0], mms, rtol=1e-10, atol=1e-10)
+    np.testing.assert_allclose(out[1], mms2, rtol=1e-10, atol=1e-10)
+    np.testing.assert_allclose(
+        out_comb, 0.75 * mms + 0.25 * mms2, rtol=1e-10, atol=1e-10
+    )
+    return
+
+
+def test_band_measure():
+    scale = 0.2
+    rcut = 16
+    ny, nx = 128, 256
+    band_cube = np.stack(
+        [simulate_gal_psf(scale, seed, rcut, ny, nx)[0] for seed in [11, 12, 13]]
+    )
+    psf_data = simulate_gal_psf(scale, 11, rcut, ny, nx)[1]
+    psf_data2 = np.pad(psf_data, ((ny // 2 - rcut,) * 2, (nx // 2 - rcut,) * 2))
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    weights = np.array([0.5, 0.3, 0.2])
+    coords, out_bands, out = task.measure_bands(
+        band_cube, psf_data2, weights, thres=0.01, thres2=-0.001, bound=rcut
+    )
+    img_data = np.tensordot(weights, band_cube, axes=1)
+    coords2 = task.detect_sources(img_data, psf_data2, 0.01, -0.001, bound=rcut)
+    np.testing.assert_array_equal(coords, coords2)
+    assert len(coords) > 0
+    for ib in range(len(band_cube)):
+        mms = np.array(task.measure(band_cube[ib], coords))
+        np.testing.assert_allclose(out_bands[ib], mms, rtol=1e-10, atol=1e-10)
+    mms = np.array(task.measure(img_data, coords))
+    np.testing.assert_allclose(out, mms, rtol=1e-10, atol=1e-10)
+    return
+
+
+def test_tiled_detect():
+    scale = 0.2
+    rcut = 16
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 14, rcut, 192, 320)
+    gal_data = gal_data + np.random.RandomState(14).normal(0.0, 0.01, gal_data.shape)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    coords = np.array(task.detect_sources(gal_data, psf_data, 0.02, -0.001, bound=4))
+    assert len(coords) > 0
+    # the fused detection is the same as convolving with the two kernels
+    img_conv = fpfs.imgutil.convolve2gausspsf(
+        gal_data, fpfs.imgutil.pad_psf(psf_data, gal_data.shape), task.sigmaf, task.klim
+    )
+    img_conv_det = fpfs.imgutil.convolve2gausspsf(
+        gal_data,
+        fpfs.imgutil.pad_psf(psf_data, gal_data.shape),
+        task.sigmaf_det,
+        task.klim,
+    )
+    coords2 = fpfs.imgutil.find_peaks(img_conv, img_conv_det, 0.02, -0.001, 4).T
+    np.testing.assert_array_equal(coords, coords2)
+    for tile_size, ncores in [(64, 1), (100, 3)]:
+        coords2 = task.detect_sources_tiled(
+            gal_data,
+            psf_data,
+            0.02,
+            -0.001,
+            bound=4,
+            tile_size=tile_size,
+            ncores=ncores,
+        )
+        np.testing.assert_array_equal(coords, coords2)
+    return
+
+
+def test_detect_measure():
+    scale = 0.2
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 15, 16)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    coords = np.array(task.detect_sources(gal_data, psf_data, 0.02, -0.001))
+    mms = np.array(task.measure(gal_data, coords))
+    coords2, mms2 = task.detect_measure(
+        gal_data, psf_data, 0.02, -0.001, max_peaks=16, chunk_size=4
+    )
+    np.testing.assert_array_equal(coords, coords2)
+    np.testing.assert_allclose(mms, mms2, rtol=1e-10, atol=1e-10)
+    # the sources beyond the capacity are dropped
+    coords3, mms3 = task.detect_measure(
+        gal_data, psf_data, 0.02, -0.001, max_peaks=2, chunk_size=2
+    )
+    np.testing.assert_array_equal(coords[:2], coords3)
+    np.testing.assert_allclose(mms[:2], mms3, rtol=1e-10, atol=1e-10)
+    return
+
+
+def test_remove_close_peaks():
+    rng = np.random.RandomState(16)
+    coords = rng.randint(0, 100, (500, 2))
+    values = rng.uniform(size=500)
+    for min_sep in [1.5, 4.0, 9.0]:
+        # greedy selection from the brightest peak
+        keep = []
+        for i in np.argsort(-values, kind="stable"):
+            dd = np.sum((coords[keep] - coords[i]) ** 2.0, axis=-1)
+            if np.all(dd >= min_sep**2.0):
+                keep.append(i)
+        keep2 = fpfs.imgutil.remove_close_peaks(coords, values, min_sep)
+        np.testing.assert_array_equal(np.nonzero(keep2)[0], np.sort(keep))
+
+    gal_data, psf_data, _ = simulate_gal_psf(0.2, 16, 16, 192, 320)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=0.2,
+    )
+    coords = np.array(task.detect_sources(gal_data, psf_data, 0.02, -0.001, bound=4))
+    coords2 = np.array(
+        task.detect_sources(gal_data, psf_data, 0.02, -0.001, bound=4, min_sep=100.0)
+    )
+    coords3 = task.detect_sources_tiled(
+        gal_data, psf_data, 0.02, -0.001, bound=4, tile_size=64, min_sep=100.0
+    )
+    np.testing.assert_array_equal(coords2, coords3)
+    assert 0 < len(coords2) < len(coords)
+    assert np.all(np.isin(coords2[:, 0] * 1000 + coords2[:, 1], coords @ [1000, 1]))
+    return
+
+
+def test_masked_measure():
+    scale = 0.2
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 17, 16, 192, 320)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    coords = np.array(task.detect_sources(gal_data, psf_data, 0.02, -0.001, bound=4))
+    mask = np.zeros(gal_data.shape, dtype=int)
+    coords2 = task.detect_sources(gal_data, psf_data, 0.02, -0.001, bound=4, mask=mask)
+    np.testing.assert_array_equal(coords, coords2)
+    # a bad column and a cosmic ray
+    gal_data2 = gal_data.copy()
+    mask[:, 90:92] = 1
+    mask[64, 128] = 2
+    gal_data2[mask != 0] = 1e4
+    coords2 = task.detect_sources(gal_data2, psf_data, 0.02, -0.001, bound=4, mask=mask)
+    np.testing.assert_array_equal(coords, coords2)
+    coords2 = task.detect_sources_tiled(
+        gal_data2, psf_data, 0.02, -0.001, bound=4, tile_size=64, mask=mask
+    )
+    np.testing.assert_array_equal(coords, coords2)
+    mms, frac = task.measure_masked(gal_data2, mask, coords, chunk_size=4)
+    mms2 = np.array(task.measure(np.where(mask != 0, 0.0, gal_data), coords))
+    np.testing.assert_allclose(mms, mms2, rtol=1e-10, atol=1e-10)
+    assert np.all(frac[coords[:, 1] > 100] < 1e-6)
+    assert np.all(frac[np.abs(coords[:, 1] - 91) < 8] > 0.01)
+    return
+
+
+def test_detect_modes():
+    scale = 0.2
+    gal_data, psf_data, coords = simulate_gal_psf(scale, 18, 16, 192, 320)
+    gal_data = gal_data + np.random.RandomState(18).normal(0.0, 0.01, gal_data.shape)
+    task = fpfs.image.measure_source(
+        psf_data,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        pix_scale=scale,
+    )
+    coords = np.array(task.detect_sources(gal_data, psf_data, 0.02, -0.001))
+    mms = task.get_results(task.measure(gal_data, coords))
+    coords2, mms2 = task.detect_modes(
+        gal_data, psf_data, 0.02, -0.001, max_peaks=64, chunk_size=8
+    )
+    np.testing.assert_array_equal(coords, coords2)
+    # the modes are measured on the full image instead of stamps
+    for nn in mms2.dtype.names:
+        np.testing.assert_allclose(
+            mms[nn], mms2[nn], atol=1e-5 * np.max(np.abs(mms[nn]))
+        )
+    # the capacity is increased if more sources are detected
+    coords3, mms3 = task.detect_modes(
+        gal_data, psf_data, 0.02, -0.001, max_peaks=2, chunk_size=2
+    )
+    np.testing.assert_array_equal(coords, coords3)
+    # tiled detection
+    coords3, mms3 = task.detect_modes(
+        gal_data, psf_data, 0.02, -0.001, max_peaks=4, chunk_size=4, tile_size=64
+    )
+    np.testing.assert_array_equal(coords, coords3)
+    for nn in mms2.dtype.names:
+        np.testing.assert_allclose(
+            mms2[nn], mms3[nn], atol=1e-6 * np.max(np.abs(mms2[nn]))
+        )
+    coords2, _ = task.detect_modes(gal_data, psf_data, 0.02, -0.001, min_sep=100.0)
+    coords3, _ = task.detect_modes(
+        gal_data, psf_data, 0.02, -0.001, min_sep=100.0, tile_size=64
+    )
+    np.testing.assert_array_equal(coords2, coords3)
+    assert 0 < len(coords2) < len(coords)
+    return
+
+
+def test_shapelet_modes():
+    ngrid, nord = 64, 6
+    chi = fpfs.imgutil.shapelets2d(ngrid, nord, 0.4, 2.9)
+    modes = [(0, 0), (2, 2), (5, 1), (6, 0)]
+    chi2 = fpfs.imgutil.shapelets2d_modes(ngrid, modes, 0.4, 2.9)
+    assert chi2.dtype == np.complex128
+    for (nn, mm), cc in zip(modes, chi2):
+        np.testing.assert_allclose(
+            chi[nn * (nord + 1) + mm], cc, rtol=0.0, atol=1e-7 * np.max(np.abs(cc))
+        )
+    # detlets with the phase factor of each direction on the full grid
+    sigma, klim = 0.4, 2.9
+    psi = fpfs.imgutil.detlets2d(ngrid, sigma, klim, dtype=np.complex128)
+    gauss, (k2, k1) = fpfs.imgutil._fourier_grids(ngrid, sigma, klim)
+    gauss = gauss / ngrid**2.0
+    q1 = (k1**2.0 - k2**2.0) / sigma**2.0 * gauss
+    for ii in [0, 3, 6]:
+        x, y = np.cos(np.pi / 4.0 * ii), np.sin(np.pi / 4.0 * ii)
+        foub = np.exp(1j * (k1 * x + k2 * y))
+        np.testing.assert_allclose(psi[ii, 0], gauss * (1.0 - foub), atol=1e-15)
+        np.testing.assert_allclose(
+            psi[ii, 1],
+            q1 - (q1 - 1j * (x * k1 - y * k2) * gauss) * foub,
+            atol=1e-15,
+        )
+    # the (truncated) bases of new klim and klim_pix do not compile programs
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger = logging.getLogger("jax")
+    logger.addHandler(handler)
+    try:
+        with jax.log_compiles():
+            for kpix in [9, 11]:
+                for name in ["chi", "psi", "bfunc"]:
+                    fpfs.imgutil.get_basis(
+                        name, ngrid, 4, sigma, klim + kpix / 10.0, 0.3, kpix
+                    )
+    finally:
+        logger.removeHandler(handler)
+    assert not any("Compiling" in rr.getMessage() for rr in records)
+    return
+
+
+if __name__ == "__main__":
+    test_chunked_measure()
+    test_rfft_measure()
+    test_mode_subset()
+    test_kernel_measure()
+    test_dense_measure()
+    test_float32_measure()
+    test_edge_measure()
+    test_psf_field_measure()
+    test_epoch_measure()
+    test_band_measure()
+    test_tiled_detect()
+    test_detect_measure()
+    test_remove_close_peaks()
+    test_masked_measure()
+    test_detect_modes()
+    test_shapelet_modes()
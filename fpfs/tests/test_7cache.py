@@ -0,0 +1,238 @@
+import jax
+import fpfs
+import galsim
+import logging
+import pathlib
+import tempfile
+import numpy as np
+from configparser import ConfigParser
+
+
+def simulate_psf(scale, rcut, fwhm=0.6):
+    psf_obj = galsim.Moffat(beta=3.5, fwhm=fwhm, trunc=fwhm * 4.0).shear(
+        e1=0.02, e2=-0.02
+    )
+    psf_data = (
+        psf_obj.shift(0.5 * scale, 0.5 * scale)
+        .drawImage(nx=64, ny=64, scale=scale)
+        .array
+    )
+    psf_data = psf_data[32 - rcut : 32 + rcut, 32 - rcut : 32 + rcut]
+    return psf_data
+
+
+def test_task_cache():
+    scale = 0.2
+    psf_data = simulate_psf(scale, 16)
+    fpfs.cache.clear_task_cache()
+    task = fpfs.cache.get_measure_source(
+        psf_data, pix_scale=scale, sigma_arcsec=0.55, sigma_detect=0.5
+    )
+    # the same configuration returns the same (compiled) task
+    task2 = fpfs.cache.get_measure_source(
+        psf_data.copy(), pix_scale=scale, sigma_arcsec=0.55, sigma_detect=0.5
+    )
+    assert task is task2
+    # different configurations return different tasks
+    task3 = fpfs.cache.get_measure_source(
+        psf_data, pix_scale=scale, sigma_arcsec=0.6, sigma_detect=0.5
+    )
+    assert task3 is not task
+    task4 = fpfs.cache.get_measure_source(
+        simulate_psf(scale, 16, fwhm=0.7),
+        pix_scale=scale,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+    )
+    assert task4 is not task
+    task5 = fpfs.cache.get_measure_source(
+        psf_data,
+        pix_scale=scale,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        modes=["fpfs_M00"],
+    )
+    assert task5 is not task
+    # array arguments are keyed by content
+    task6 = fpfs.cache.get_measure_source(
+        psf_data,
+        pix_scale=scale,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        modes=np.array(["fpfs_M00"]),
+    )
+    assert task6 is not task5
+    task7 = fpfs.cache.get_measure_source(
+        psf_data,
+        pix_scale=scale,
+        sigma_arcsec=0.55,
+        sigma_detect=0.5,
+        modes=np.array(["fpfs_M00"]),
+    )
+    assert task7 is task6
+    fpfs.cache.clear_task_cache()
+    return
+
+
+def test_compile_measure_source():
+    scale = 0.2
+    psf_data = simulate_psf(scale, 16)
+    task = fpfs.image.measure_source(
+        psf_data, pix_scale=scale, sigma_arcsec=0.55, sigma_detect=0.5
+    )
+    fpfs.cache.compile_measure_source(
+        task, (64, 96), chunk_size=8, psf_data=psf_data, min_sep=3.0
+    )
+    img = np.zeros((64, 96))
+    img[28:36, 40:48] = 1.0
+    img[30:32, 50:52] = 0.5
+    # nothing is compiled by the detection and measurement after warming up
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger = logging.getLogger("jax")
+    logger.addHandler(handler)
+    try:
+        with jax.log_compiles():
+            coords = task.detect_sources(
+                img, psf_data, 0.01, 0.0, bound=8, min_sep=3.0
+            )
+            out = task.measure(img, coords, chunk_size=8)
+            coords2 = np.array([[32, 44], [30, 50], [34, 40]])
+            out2 = task.measure(img, coords2, chunk_size=8)
+    finally:
+        logger.removeHandler(handler)
+    assert len(coords) > 0
+    assert not any("Compiling" in rr.getMessage() for rr in records)
+    np.testing.assert_allclose(out, task.measure(img, coords), rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(
+        out2, task.measure(img, coords2), rtol=1e-12, atol=1e-12
+    )
+    out = task.measure(img, np.zeros((0, 2), dtype=int), chunk_size=8)
+    assert out.shape == (0, len(task.mode_types))
+    return
+
+
+def test_klim():
+    scale = 0.2
+    psf_data = simulate_psf(scale, 32)
+    psf_pow = np.abs(np.fft.fftshift(np.fft.fft2(psf_data))) ** 2.0
+    sigma = 3.0
+    # walk outward along the two principal axes
+    klim = 64 // 5
+    while klim < 32:
+        gg = np.exp(-(klim**2.0) / 2.0 / sigma**2.0)
+        vv = min(gg / psf_pow[32 + klim, 32], gg / psf_pow[32, 32 + klim])
+        if vv <= 1e-20:
+            break
+        klim += 1
+    assert fpfs.imgutil.get_klim(psf_pow, sigma) == klim
+    # memoized
+    assert fpfs.imgutil.get_klim(psf_pow.copy(), sigma) == klim
+    # requiring the truncation in all directions is more conservative
+    assert fpfs.imgutil.get_klim(psf_pow, sigma, azimuth=True) >= klim
+    return
+
+
+def test_psf_product(tmp_path):
+    scale = 0.2
+    psf_data = simulate_psf(scale, 16).astype(np.float64)
+    psf_data2 = fpfs.imgutil.pad_psf(psf_data, (64, 96))
+    np.testing.assert_array_equal(psf_data2, np.pad(psf_data, ((16, 16), (32, 32))))
+    out = fpfs.imgutil.get_psf_product(psf_data, "rfft", (64, 96))
+    np.testing.assert_allclose(
+        out, np.fft.rfft2(np.fft.ifftshift(psf_data2)), rtol=1e-12, atol=1e-14
+    )
+    assert fpfs.imgutil.get_psf_product(psf_data.copy(), "rfft", (64, 96)) is out
+    # on-disk store
+    fpfs.cache.enable_psf_cache(str(tmp_path))
+    fpfs.imgutil._psf_product_cache.clear()
+    try:
+        out2 = fpfs.imgutil.get_psf_product(psf_data, "fft")
+        assert len(list(tmp_path.glob("*_fft_32x32.npy"))) == 1
+        fpfs.imgutil._psf_product_cache.clear()
+        np.testing.assert_array_equal(
+            out2, fpfs.imgutil.get_psf_product(psf_data, "fft")
+        )
+        # products from the store are memory-mapped
+        assert isinstance(out2, np.memmap)
+    finally:
+        fpfs.imgutil.psf_product_dir = None
+    # the in-memory cache is bounded by bytes
+    nbytes = fpfs.imgutil.psf_product_cache_bytes
+    fpfs.imgutil.psf_product_cache_bytes = out.nbytes
+    fpfs.imgutil._psf_product_cache.clear()
+    try:
+        out = fpfs.imgutil.get_psf_product(psf_data, "rfft", (64, 96))
+        assert fpfs.imgutil.get_psf_product(psf_data, "rfft", (64, 96)) is out
+        # the least recently used product is evicted
+        out3 = fpfs.imgutil.get_psf_product(psf_data, "rfft", (64, 94))
+        assert len(fpfs.imgutil._psf_product_cache) == 1
+        assert fpfs.imgutil.get_psf_product(psf_data, "rfft", (64, 94)) is out3
+        # larger than the limit, the last product is still cached in memory
+        out4 = fpfs.imgutil.get_psf_product(psf_data, "rfft", (96, 96))
+        assert out4.nbytes > fpfs.imgutil.psf_product_cache_bytes
+        assert fpfs.imgutil.get_psf_product(psf_data, "rfft", (96, 96)) is out4
+        assert len(fpfs.imgutil._psf_product_cache) == 1
+        assert fpfs.imgutil.get_psf_product(psf_data, "rfft", (64, 94)) is not out3
+    finally:
+        fpfs.imgutil.psf_product_cache_bytes = nbytes
+    return
+
+
+def test_basis_cache(tmp_path):
+    fpfs.cache.enable_basis_cache(str(tmp_path))
+    fpfs.imgutil._basis_cache.clear()
+    try:
+        chi = fpfs.imgutil.get_basis("chi", 64, 4, 3.0, 20, klim_pix=10)
+        assert chi.shape == (5, 21, 21)
+        full = fpfs.imgutil.shapelets2d_modes(
+            64, fpfs.imgutil.shapelet_modes[4], 3.0, 20
+        )
+        np.testing.assert_array_equal(chi, full[:, 22:43, 22:43])
+        assert len(list(tmp_path.glob("chi_*.npy"))) == 1
+        fpfs.imgutil._basis_cache.clear()
+        np.testing.assert_array_equal(
+            chi, fpfs.imgutil.get_basis("chi", 64, 4, 3.0, 20, klim_pix=10)
+        )
+        # the truncated bases are generated on the pixels within klim_pix
+        psi = fpfs.imgutil.get_basis("psi", 64, 4, 0.4, 2.9, klim_pix=10)
+        full = fpfs.imgutil.detlets2d(64, 0.4, 2.9, dtype=np.complex128)
+        np.testing.assert_array_equal(psi, full[..., 22:43, 22:43])
+    finally:
+        fpfs.imgutil.basis_dir = None
+        fpfs.imgutil._basis_cache.clear()
+    return
+
+
+def test_enable_caches(tmp_path):
+    cparser = ConfigParser()
+    cparser.read_dict(
+        {
+            "files": {
+                "psf_cache_dir": str(tmp_path / "psf"),
+                "basis_cache_dir": str(tmp_path / "basis"),
+            }
+        }
+    )
+    try:
+        fpfs.cache.enable_caches(cparser, "files")
+        assert fpfs.imgutil.psf_product_dir == str(tmp_path / "psf")
+        assert fpfs.imgutil.basis_dir == str(tmp_path / "basis")
+        assert (tmp_path / "psf").is_dir() and (tmp_path / "basis").is_dir()
+    finally:
+        fpfs.imgutil.psf_product_dir = None
+        fpfs.imgutil.basis_dir = None
+    return
+
+
+if __name__ == "__main__":
+    test_task_cache()
+    test_compile_measure_source()
+    test_klim()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_psf_product(pathlib.Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_basis_cache(pathlib.Path(tmp_dir))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_enable_caches(pathlib.Path(tmp_dir))
@@ -17,6 +17,8 @@ scripts = [
     "bin/fpfs_summary_sim.py",
     "bin/fpfs_process_descsim.py",
     "bin/fpfs_summary_descsim.py",
+    "bin/fpfs_benchmark.py",
+    "bin/fpfs_warmup.py",
 ]
 
 